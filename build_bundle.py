@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+"""Builds the OTA bundle pulled by ugit when Bundle is set in the Github config.
+
+Usage: build_bundle.py [output]  (default: bundle/esp32.bundle)
+
+Commit the bundle along with the changes, the device finds it in the git tree.
+"""
+import ast
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import zlib
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def ugit_settings() -> dict:
+    """The settings of the device side, read from ugit.py as it does not run on the host."""
+    with open(os.path.join(ROOT, "esp32", "ugit.py")) as f:
+        tree = ast.parse(f.read())
+    settings = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in ("IGNORE_FILES", "GIT_SUBFOLDER", "BUNDLE_WBITS"):
+                settings[name] = ast.literal_eval(node.value)
+    return settings
+
+
+def blob_sha(content: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def build(output: str) -> None:
+    settings = ugit_settings()
+    subfolder = settings["GIT_SUBFOLDER"]
+
+    # Only tracked files, the certificates and the like stay out.
+    paths = subprocess.check_output(["git", "ls-files", subfolder], cwd=ROOT, text=True).split()
+    index = []
+    contents = []
+    for path in sorted(paths):
+        if path in settings["IGNORE_FILES"]:
+            continue
+        with open(os.path.join(ROOT, path), "rb") as f:
+            content = f.read()
+        index.append([path[len(subfolder) :], len(content), blob_sha(content)])
+        contents.append(content)
+
+    index = json.dumps(index, separators=(",", ":")).encode()
+    compressor = zlib.compressobj(9, zlib.DEFLATED, settings["BUNDLE_WBITS"])
+    data = compressor.compress(struct.pack(">I", len(index)) + index)
+    for content in contents:
+        data = data + compressor.compress(content)
+    data = data + compressor.flush()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "wb") as f:
+        f.write(data)
+    print(f"Bundled {len(contents)} files into {output}, {len(data)} bytes.")
+
+
+if __name__ == "__main__":
+    build(sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, "bundle", "esp32.bundle"))
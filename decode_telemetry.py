@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+"""Decodes binary telemetry messages published by the devices.
+
+Usage: decode_telemetry.py <hex payload>  or pipe the raw payload via stdin.
+"""
+import json
+import os
+import sys
+
+# The schema table lives next to the encoder that runs on the device.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "esp32"))
+from telemetry import decode
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        payload = bytes.fromhex(sys.argv[1])
+    else:
+        payload = sys.stdin.buffer.read()
+
+    print(json.dumps(decode(payload), indent=4))
@@ -0,0 +1,102 @@
+"""Rolling Window Aggregation"""
+from array import array
+import math
+
+# Suffixes of the summary fields, the last value keeps the plain field name.
+STATS = ("_min", "_max", "_mean", "_std")
+# Decimals of the summary values. More than the sensors resolve only lengthens
+# the payload, a float32 prints with up to 17 digits.
+DIGITS = 2
+
+
+class Window:
+    """Ring buffer of the last size values of a single field."""
+
+    def __init__(self, size):
+        self.size = size
+        self.values = array("f", [0.0] * size)
+        self.count = 0
+        self.pos = 0
+        self.last = 0.0
+
+    def add(self, value):
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count = self.count + 1
+        self.last = value
+
+    def clear(self):
+        self.count = 0
+        self.pos = 0
+
+    def stats(self):
+        """Returns min, max, mean and standard deviation of the window."""
+        values = self.values
+        lo = hi = values[0]
+        total = 0.0
+        for i in range(self.count):
+            v = values[i]
+            if v < lo:
+                lo = v
+            if v > hi:
+                hi = v
+            total = total + v
+        mean = total / self.count
+
+        var = 0.0
+        for i in range(self.count):
+            d = values[i] - mean
+            var = var + d * d
+        return lo, hi, mean, math.sqrt(var / self.count)
+
+
+class Aggregator:
+    """Windows of size samples for up to max_fields fields of the readings.
+
+    The windows are created when a field shows up first, so the memory is
+    bounded by max_fields * size * 4 bytes and does not grow afterwards.
+    """
+
+    def __init__(self, size, max_fields=16):
+        self.size = size
+        self.max_fields = max_fields
+        self.windows = {}
+
+    def add(self, data):
+        for name, value in data.items():
+            window = self.windows.get(name)
+            if window is None:
+                if len(self.windows) >= self.max_fields:
+                    continue
+                window = Window(self.size)
+                self.windows[name] = window
+            window.add(value)
+
+    def summary(self):
+        """Returns min, max, mean, standard deviation and last value of every field."""
+        data = {}
+        for name, window in self.windows.items():
+            if not window.count:
+                continue
+            data[name] = round(window.last, DIGITS)
+            for suffix, value in zip(STATS, window.stats()):
+                data[name + suffix] = round(value, DIGITS)
+        return data
+
+    def resize(self, size):
+        """Change the window size, e.g. for a new publishing interval.
+        The newest samples taken so far are kept as far as they fit."""
+        self.size = size
+        for name, old in self.windows.items():
+            window = Window(size)
+            # The oldest sample is at pos once the ring buffer wrapped.
+            start = old.pos if old.count == old.size else 0
+            for i in range(max(0, old.count - size), old.count):
+                window.add(old.values[(start + i) % old.size])
+            window.last = old.last
+            self.windows[name] = window
+
+    def clear(self):
+        for window in self.windows.values():
+            window.clear()
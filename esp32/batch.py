@@ -0,0 +1,67 @@
+"""Batched Publishing"""
+import json
+
+# Overhead of the json array separator per sample.
+_SEPARATOR_SIZE = 2
+
+
+class Batch:
+    """Collects several readings into one payload.
+
+    The fields in header are sent once per batch, every sample carries its
+    offset in ms to the timestamp of the first sample instead. Timestamps
+    are in ms, window is in seconds.
+    The batch is ready once it holds size samples, once window seconds
+    passed since the first sample, or once the next sample could push the
+    payload above max_bytes.
+    """
+
+    def __init__(self, header, size=10, window=600, max_bytes=16384):
+        self.header = header
+        self.size = size
+        self.window = window
+        self.max_bytes = max_bytes
+        # Size of the header including the timestamps, samples key and brackets.
+        self.header_bytes = len(json.dumps(header)) + 64
+        self.clear()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def clear(self):
+        self.samples = []
+        self.start = None
+        self.nbytes = self.header_bytes
+        self.last_bytes = 0
+
+    def add(self, sample, timestamp):
+        """Add a reading without the header fields taken at timestamp."""
+        if self.start is None:
+            self.start = timestamp
+        sample["offset"] = timestamp - self.start
+        self.last_bytes = len(json.dumps(sample)) + _SEPARATOR_SIZE
+        self.nbytes = self.nbytes + self.last_bytes
+        self.samples.append(sample)
+
+    def ready(self, now):
+        if not self.samples:
+            return False
+        return (
+            len(self.samples) >= self.size
+            or now - self.start >= self.window * 1000
+            or self.nbytes + self.last_bytes > self.max_bytes
+        )
+
+    def dumps(self, start, timestamp):
+        """Serialise the batch, start is the formatted time of the first sample
+        and timestamp its unix time in ms."""
+        data = {"datetime": start, "timestamp": timestamp, "samples": self.samples}
+        data.update(self.header)
+        return json.dumps(data)
+
+    def readings(self):
+        """Yields the samples without offset along with their timestamp."""
+        for sample in self.samples:
+            reading = dict(sample)
+            timestamp = self.start + reading.pop("offset")
+            yield timestamp, reading
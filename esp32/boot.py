@@ -1,5 +1,4 @@
 """Entrypoint"""
-from json import load
 import machine
 import network
 import time
@@ -10,12 +9,15 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 logger.info("\n\n-------------------- Started Bootloader ESP32 --------------------\n")
+# Roll back an OTA update which did not boot properly.
+ugit.boot_check()
 
 try:
-    with open("configs/config.json", "r") as json_file:
-        CFG = load(json_file)
+    # Parsed and validated once, shared with main. Raises only after the
+    # boot check, so a bad update is still rolled back.
+    from config import CFG
 except Exception as e:
-    logger.error("Failed to load config file.")
+    logger.error(f"Failed to load config file. {e}")
 
 
 def enable_garbage_collection() -> None:
@@ -48,8 +50,12 @@ def connect_wifi() -> None:
 
 # Pull out the sluggish.
 enable_garbage_collection()
-# Establish WIFI connection.
-sta_if = connect_wifi()
+if CFG["Deep_sleep"]["Boolean"] and machine.reset_cause() == machine.DEEPSLEEP_RESET:
+    # Woken up from deep sleep, main.py connects only when there is something to publish.
+    sta_if = network.WLAN(network.STA_IF)
+else:
+    # Establish WIFI connection.
+    sta_if = connect_wifi()
 # Updating the Device via Github.
 # ugit.update()
 # WebRepl
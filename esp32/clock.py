@@ -0,0 +1,62 @@
+"""Drift Corrected Time"""
+import time
+from ntptime import ntptime
+
+# Syncs closer than this are dominated by the network jitter.
+_MIN_DRIFT_SPAN = 600000
+
+
+class Clock:
+    """Millisecond time of the RTC synced by NTP every interval seconds.
+
+    Every sync measures how far the RTC ran off since the previous one. The
+    drift rate in ppm, clamped to max_drift, is averaged and applied to the
+    time read until the next sync.
+    """
+
+    def __init__(self, interval=3600, max_drift=500):
+        self.interval = interval
+        self.max_drift = max_drift
+        self.drift = 0.0
+        # RTC time in ms of the last sync, None before the first one.
+        self.synced = None
+        # Correction and round trip of the last sync in ms.
+        self.offset = 0
+        self.rtt = 0
+
+    def now_ms(self):
+        t = ntptime.rtc_ms()
+        if self.synced is not None and self.drift:
+            t = t + int((t - self.synced) * self.drift / 1000000)
+        return t
+
+    def now(self):
+        return self.now_ms() // 1000
+
+    def due(self):
+        """Whether the next sync is due."""
+        if self.synced is None:
+            return True
+        return ntptime.rtc_ms() - self.synced >= self.interval * 1000
+
+    def restore(self, synced, drift):
+        """Continue with the state of a previous boot, e.g. before deep sleep."""
+        self.synced = synced
+        self.drift = drift
+
+    def sync(self):
+        """Set the RTC from NTP and update the drift. Raises if no server answers."""
+        t, ticks, self.rtt = ntptime.time_ms()
+        local = ntptime.rtc_ms()
+        server = t + time.ticks_diff(time.ticks_ms(), ticks)
+        self.offset = server - local
+
+        if self.synced is not None and local - self.synced >= _MIN_DRIFT_SPAN:
+            # Measured on the raw RTC, the correction is not part of it.
+            drift = self.offset * 1000000 / (local - self.synced)
+            drift = max(-self.max_drift, min(self.max_drift, drift))
+            self.drift = drift if not self.drift else (self.drift + drift) / 2
+
+        server = t + time.ticks_diff(time.ticks_ms(), ticks)
+        ntptime.setrtc(server)
+        self.synced = server
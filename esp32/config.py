@@ -0,0 +1,282 @@
+"""Configuration
+
+The config file is parsed and validated once per change. Keys it lacks are
+taken from DEFAULTS, OTA updates never touch it. The result is kept as
+python module next to it, keyed by the hash of the json and of this module,
+so later boots only hash the files and import the module. All modules share the CFG of this
+module and must not modify it, changes at runtime go through update.
+"""
+import binascii
+import hashlib
+import json
+import os
+
+PATH = "configs/config.json"
+# Validated copy of PATH, rebuilt once the hash of PATH or of this module changed.
+CACHE = "config_cache.py"
+
+_NUM = (int, float)
+_STR_OR_NONE = (str, type(None))
+_INT_OR_NONE = (int, type(None))
+
+# Type of every key the modules rely on, nested sections as dicts.
+SCHEMA = {
+    "Network": {"SSID": str, "PASS": str},
+    "SCD30_offsets": {"tempOffset": _NUM, "co2Offset": _NUM, "humidityOffset": _NUM},
+    "AWS_IOT_core": {
+        "THING_NAME": str,
+        "TOPIC": str,
+        "ENDPOINT": str,
+        "ROOT_CA": str,
+        "CERTIFICATE": str,
+        "PRIVATE_KEY": str,
+    },
+    "Github": {
+        "user": str,
+        "repo": str,
+        "secret_access_token": str,
+        "Confirm_Timeout": int,
+        "Bundle": str,
+    },
+    "Session": {
+        "Keepalive": int,
+        "Backoff": _NUM,
+        "Max_Backoff": _NUM,
+        "Watchdog": int,
+        "QoS": int,
+        "Inflight": int,
+        "Retransmit": int,
+    },
+    "Sensors": {
+        "SCD30": {
+            "Pin": list,
+            "Boolean": int,
+            "CO2_Value": _NUM,
+            "Hardware_I2C": int,
+            "Frequency": int,
+            "Ready_Timeout": int,
+            "RDY_Pin": _INT_OR_NONE,
+        },
+        "Moisture_Sensor": {
+            "Pin": list,
+            "Boolean": int,
+            "Samples": int,
+            "Filter": str,
+            "Calibration": list,
+        },
+        "DS18B20": {
+            "Pin": list,
+            "Boolean": int,
+            "Name": list,
+            "Resolution": int,
+            "ROM_Names": dict,
+            "ROM_Cache": str,
+        },
+        "AM2302": {"Pin": int, "Boolean": int},
+    },
+    "Store_and_forward": {"File": str, "Records": int, "Record_Size": int, "Drain_Rate": int},
+    "Batching": {"Boolean": int, "Size": int, "Window": int, "Max_Bytes": int},
+    "Aggregation": {"Boolean": int, "Sample_Interval": _NUM, "Max_Fields": int},
+    "Deadband": {"Boolean": int, "Thresholds": dict, "Default": _NUM, "Heartbeat": int},
+    "Deep_sleep": {"Boolean": int, "NTP_Resync": int, "WiFi_Timeout": int},
+    "NTP": {"Hosts": list, "Resync": int, "Timeout": _NUM},
+    "Logging": {
+        "File": _STR_OR_NONE,
+        "Max_Bytes": int,
+        "Backups": int,
+        "Flush_Interval": int,
+        "Remote": {"Boolean": int, "Capacity": int, "Batch_Size": int, "Interval": int},
+    },
+    "Device_settings": {"Time_Interval": int, "location": str, "UTC_Offset": _NUM, "Encoding": str},
+}
+
+_FLAG = (0, 1)
+_POSITIVE = (1, None)
+_NON_NEGATIVE = (0, None)
+
+# Values of the keys that have been added since the first release, so the
+# config of a device updated over the air is complete.
+DEFAULTS = {
+    "Github": {"Confirm_Timeout": 600, "Bundle": ""},
+    "Session": {
+        "Keepalive": 300,
+        "Backoff": 2,
+        "Max_Backoff": 300,
+        "Watchdog": 3600,
+        "QoS": 1,
+        "Inflight": 8,
+        "Retransmit": 10,
+    },
+    "Sensors": {
+        "SCD30": {"Hardware_I2C": 1, "Frequency": 50000, "Ready_Timeout": 3000, "RDY_Pin": None},
+        "Moisture_Sensor": {
+            "Samples": 16,
+            "Filter": "median",
+            "Calibration": [[4095, 1515], [4095, 1515], [4095, 1515], [4095, 1515]],
+        },
+        "DS18B20": {"Resolution": 12, "ROM_Names": {}, "ROM_Cache": "ds18b20.json"},
+    },
+    "Store_and_forward": {"File": "spool.dat", "Records": 128, "Record_Size": 512, "Drain_Rate": 10},
+    "Batching": {"Boolean": 0, "Size": 10, "Window": 600, "Max_Bytes": 16384},
+    "Aggregation": {"Boolean": 0, "Sample_Interval": 2, "Max_Fields": 16},
+    "Deadband": {
+        "Boolean": 0,
+        "Thresholds": {},
+        "Default": 1.0,
+        "Heartbeat": 900,
+    },
+    "Deep_sleep": {"Boolean": 0, "NTP_Resync": 86400, "WiFi_Timeout": 15},
+    "NTP": {"Hosts": ["pool.ntp.org", "time.google.com", "time.cloudflare.com"], "Resync": 3600, "Timeout": 1},
+    "Logging": {
+        "File": "log.txt",
+        "Max_Bytes": 16384,
+        "Backups": 3,
+        "Flush_Interval": 60,
+        "Remote": {"Boolean": 0, "Capacity": 32, "Batch_Size": 8, "Interval": 30},
+    },
+    "Device_settings": {"Encoding": "json"},
+}
+
+# Keys which may be changed at runtime by update, with their (min, max) range
+# or None for any value. Changes to the network, broker or certificates could
+# cut the device off for good, they are left to a new flash.
+LIVE = {
+    "SCD30_offsets": {"tempOffset": None, "co2Offset": None, "humidityOffset": None},
+    "Sensors": {
+        "SCD30": {"Boolean": _FLAG},
+        "Moisture_Sensor": {"Boolean": _FLAG},
+        "DS18B20": {"Boolean": _FLAG},
+        "AM2302": {"Boolean": _FLAG},
+    },
+    "Batching": {"Boolean": _FLAG, "Size": _POSITIVE, "Window": _POSITIVE, "Max_Bytes": (256, None)},
+    "Deadband": {
+        "Boolean": _FLAG,
+        "Thresholds": _NON_NEGATIVE,
+        "Default": _NON_NEGATIVE,
+        "Heartbeat": _NON_NEGATIVE,
+    },
+    # At most a day, the aggregation windows are sized by it.
+    "Device_settings": {"Time_Interval": (1, 86400)},
+}
+
+
+def validate(cfg: dict, schema: dict = SCHEMA, path: str = "", partial: bool = False) -> None:
+    """Raises ValueError naming the first key that is missing or of the wrong type.
+    With partial only the keys present are checked, but no unknown ones are allowed."""
+    if not isinstance(cfg, dict):
+        raise ValueError("{} must be an object".format(path or "Config"))
+    for key, kind in schema.items():
+        name = path + "." + key if path else key
+        if key not in cfg:
+            if partial:
+                continue
+            raise ValueError("Missing {}".format(name))
+        if isinstance(kind, dict):
+            validate(cfg[key], kind, name, partial)
+        elif not isinstance(cfg[key], kind):
+            raise ValueError("Wrong type of {}".format(name))
+    if partial:
+        for key in cfg:
+            if key not in schema:
+                raise ValueError("Unknown {}".format(path + "." + key if path else key))
+
+
+def digest(fpaths: tuple = (PATH, __file__)) -> str:
+    """Hash of the config and of this module, new DEFAULTS rebuild the cache too."""
+    h = hashlib.sha1()
+    buf = bytearray(512)
+    for fpath in fpaths:
+        with open(fpath, "rb") as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                h.update(memoryview(buf)[:n])
+    return binascii.hexlify(h.digest()).decode()
+
+
+def load() -> dict:
+    """Returns the cached config, or parses and validates PATH if it changed.
+    Raises ValueError only for keys without default or of the wrong type."""
+    current = digest()
+    try:
+        with open(CACHE, "r") as f:
+            cached = f.readline().strip() == 'HASH = "{}"'.format(current)
+        if cached:
+            import config_cache
+
+            return config_cache.CFG
+    except (OSError, ImportError, SyntaxError):
+        pass
+
+    with open(PATH, "r") as f:
+        cfg = merged(DEFAULTS, json.load(f))
+    validate(cfg)
+    write_cache(cfg, current)
+    return cfg
+
+
+def write_cache(cfg: dict, current: str) -> None:
+    # Renamed into place, an interrupted write only costs a parse next boot.
+    with open(CACHE + ".new", "w") as f:
+        f.write('HASH = "{}"\n'.format(current))
+        f.write("CFG = {}\n".format(repr(cfg)))
+    try:
+        os.remove(CACHE)
+    except OSError:
+        pass
+    os.rename(CACHE + ".new", CACHE)
+
+
+def update(changes: dict) -> None:
+    """Validate a partial config, persist it and apply it to CFG.
+    Raises ValueError if it does not fit SCHEMA and LIVE, and OSError if it
+    could not be saved. CFG is left unchanged in both cases."""
+    validate(changes, partial=True)
+    check_live(changes)
+    cfg = merged(CFG, changes)
+    with open(PATH + ".new", "w") as f:
+        json.dump(cfg, f)
+    try:
+        # Replaces PATH in one step on littlefs.
+        os.rename(PATH + ".new", PATH)
+    except OSError:
+        os.remove(PATH)
+        os.rename(PATH + ".new", PATH)
+    CFG.update(cfg)
+    try:
+        write_cache(CFG, digest())
+    except OSError:
+        # A stale cache is only parsed again on the next boot.
+        pass
+
+
+def check_live(changes: dict, live: dict = LIVE, path: str = "") -> None:
+    """Raises ValueError unless changes only hold keys of LIVE within their range."""
+    for key, value in changes.items():
+        name = path + "." + key if path else key
+        if key not in live:
+            raise ValueError("{} can not be changed at runtime".format(name))
+        bounds = live[key]
+        if isinstance(bounds, dict):
+            check_live(value, bounds, name)
+        elif bounds is not None:
+            # The deadband thresholds map fields to values, null ignores a field.
+            for v in value.values() if isinstance(value, dict) else [value]:
+                if v is None:
+                    continue
+                if not isinstance(v, _NUM) or v < bounds[0] or bounds[1] is not None and v > bounds[1]:
+                    raise ValueError("{} out of range".format(name))
+
+
+def merged(cfg: dict, changes: dict) -> dict:
+    """Copy of cfg with changes applied, nested sections key by key."""
+    cfg = dict(cfg)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(cfg.get(key), dict):
+            value = merged(cfg[key], value)
+        cfg[key] = value
+    return cfg
+
+
+CFG = load()
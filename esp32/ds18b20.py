@@ -0,0 +1,121 @@
+"""Sensor"""
+import binascii
+import json
+import machine
+import onewire
+import ds18x20
+
+
+class DS18B20:
+    """All DS18B20 sensors on the configured one-wire buses.
+
+    The ROM codes are searched once, cached on flash across reboots and only
+    searched again on a bus where a read failed. Every sensor on a bus is
+    read, its name is taken from rom_names by the hex ROM code. Otherwise the
+    first sensor on a bus gets the name of the bus, further ones a suffix.
+    """
+
+    def __init__(self, pins, names, rom_names=None, resolution=12, cache="ds18b20.json"):
+        self.pins = pins
+        self.names = names
+        self.rom_names = rom_names or {}
+        # Configuration register (TH, TL, config) with the resolution in bits 5 and 6.
+        self.scratch = bytes([0, 0, ((resolution - 9) << 5) | 0x1F])
+        # Each bit less of resolution halves the conversion time.
+        self.conversion_ms = 750 >> (12 - resolution)
+        self.cache = cache
+        self.buses = [ds18x20.DS18X20(onewire.OneWire(machine.Pin(pin))) for pin in pins]
+        self.roms = self.__load()
+        self.labels = [self.__label(bus, self.roms[bus]) for bus in range(len(pins))]
+        # Buses on which the ROMs have to be searched before the next conversion.
+        self.stale = [True] * len(pins)
+        self.converting = []
+        for bus in range(len(pins)):
+            if self.roms[bus]:
+                try:
+                    self.__configure(bus)
+                    self.stale[bus] = False
+                except Exception:
+                    pass
+
+    def convert(self):
+        """Start the conversion on all buses at once.
+        Returns the indices of the buses which failed to respond."""
+        self.converting = []
+        failed = []
+        for bus in range(len(self.buses)):
+            try:
+                if self.stale[bus]:
+                    self.__scan(bus)
+                # Without a ROM code the conversion is started on all sensors of the bus.
+                self.buses[bus].convert_temp()
+                self.converting.append(bus)
+            except Exception:
+                self.stale[bus] = True
+                failed.append(bus)
+        return failed
+
+    def read(self):
+        """Read all sensors on the buses converting, after conversion_ms.
+        Returns the temperatures by name and the indices of the failed buses."""
+        data = {}
+        failed = []
+        for bus in self.converting:
+            for rom, label in zip(self.roms[bus], self.labels[bus]):
+                try:
+                    data[label] = self.buses[bus].read_temp(rom)
+                except Exception:
+                    self.stale[bus] = True
+                    if bus not in failed:
+                        failed.append(bus)
+        self.converting = []
+        return data, failed
+
+    def __scan(self, bus):
+        roms = self.buses[bus].scan()
+        if not roms:
+            raise OSError("No DS18B20 on pin {}".format(self.pins[bus]))
+        if roms != self.roms[bus]:
+            self.roms[bus] = roms
+            self.labels[bus] = self.__label(bus, roms)
+            self.__save()
+        self.__configure(bus)
+        self.stale[bus] = False
+
+    def __configure(self, bus):
+        for rom in self.roms[bus]:
+            self.buses[bus].write_scratch(rom, self.scratch)
+
+    def __label(self, bus, roms):
+        name = self.names[bus] if bus < len(self.names) else "pipe_sensor_pin{}".format(self.pins[bus])
+        labels = []
+        for i in range(len(roms)):
+            key = binascii.hexlify(roms[i]).decode()
+            if key in self.rom_names:
+                labels.append(self.rom_names[key])
+            elif i == 0:
+                labels.append(name)
+            else:
+                labels.append("{}_{}".format(name, i + 1))
+        return labels
+
+    def __load(self):
+        try:
+            with open(self.cache, "r") as f:
+                cached = json.load(f)
+        except Exception:
+            cached = {}
+        return [
+            [bytearray(binascii.unhexlify(rom)) for rom in cached.get(str(pin), [])]
+            for pin in self.pins
+        ]
+
+    def __save(self):
+        cached = {}
+        for bus in range(len(self.pins)):
+            cached[str(self.pins[bus])] = [binascii.hexlify(rom).decode() for rom in self.roms[bus]]
+        try:
+            with open(self.cache, "w") as f:
+                json.dump(cached, f)
+        except Exception:
+            pass
@@ -1,5 +1,7 @@
 from micropython import const
 
+import json
+import os
 import sys
 import time
 
@@ -79,13 +81,163 @@ class FileHandler(StreamHandler):
         self.stream.close()
 
 
+class RotatingFileHandler(Handler):
+    """Writes to filename and at most backupCount older segments of maxBytes.
+
+    Records are collected in RAM and written at once when bufferSize bytes are
+    reached, a record of flushLevel or above arrives or flushInterval ms have
+    passed, see poll. Every write opens the file, so nothing is lost in an open
+    handle. Segments are only switched by renames, a crash in between costs at
+    most the oldest segment.
+    """
+
+    def __init__(
+        self,
+        filename,
+        maxBytes=16384,
+        backupCount=3,
+        bufferSize=512,
+        flushLevel=ERROR,
+        flushInterval=60000,
+    ):
+        super().__init__()
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.bufferSize = bufferSize
+        self.flushLevel = flushLevel
+        self.flushInterval = flushInterval
+        self.terminator = "\n"
+        self.buffer = []
+        self.buffered = 0
+        self.lastFlush = time.ticks_ms()
+        try:
+            self.size = os.stat(filename)[6]
+        except OSError:
+            self.size = 0
+
+    def emit(self, record):
+        if record.levelno >= self.level:
+            line = self.format(record) + self.terminator
+            self.buffer.append(line)
+            self.buffered = self.buffered + len(line)
+            if self.buffered >= self.bufferSize or record.levelno >= self.flushLevel:
+                self.flush()
+            else:
+                self.poll()
+
+    def poll(self):
+        """Flush if flushInterval ms passed since the last flush."""
+        if time.ticks_diff(time.ticks_ms(), self.lastFlush) >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        self.lastFlush = time.ticks_ms()
+        if not self.buffer:
+            return
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        try:
+            if self.size and self.size + len(data) > self.maxBytes:
+                self.rotate()
+            with open(self.filename, "a") as f:
+                f.write(data)
+            self.size = self.size + len(data)
+        except OSError:
+            # A full or failing flash must not raise into the code logging,
+            # the records are dropped instead.
+            pass
+
+    def rotate(self):
+        """Start a new segment, the oldest one is dropped."""
+        for i in range(self.backupCount, 0, -1):
+            src = self.filename if i == 1 else "{}.{}".format(self.filename, i - 1)
+            dst = "{}.{}".format(self.filename, i)
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+            try:
+                os.rename(src, dst)
+            except OSError:
+                pass
+        if not self.backupCount:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+
+class MQTTHandler(Handler):
+    """Keeps the records of level and above for publishing on topic, see send.
+
+    At most capacity records of up to maxLength characters are queued, the
+    oldest are dropped first. send publishes at most batchSize of them per
+    interval ms as json: the number of records dropped meanwhile and the
+    records as [unix time, line]. epochOffset converts the device epoch.
+    """
+
+    def __init__(
+        self,
+        topic,
+        level=WARNING,
+        capacity=32,
+        batchSize=8,
+        interval=30000,
+        maxLength=160,
+        epochOffset=0,
+    ):
+        super().__init__(level)
+        self.topic = topic
+        self.capacity = capacity
+        self.batchSize = batchSize
+        self.interval = interval
+        self.maxLength = maxLength
+        self.epochOffset = epochOffset
+        self.queue = []
+        self.dropped = 0
+        self.lastSent = time.ticks_add(time.ticks_ms(), -interval)
+
+    def emit(self, record):
+        if record.levelno >= self.level:
+            if len(self.queue) >= self.capacity:
+                self.queue.pop(0)
+                self.dropped = self.dropped + 1
+            self.queue.append([record.ct + self.epochOffset, self.format(record)[: self.maxLength]])
+
+    def send(self, client):
+        """Publish the next batch via client unless the last one was sent less
+        than interval ms ago. Returns the number of records sent, the records
+        stay queued if publishing raises."""
+        if not self.queue or time.ticks_diff(time.ticks_ms(), self.lastSent) < self.interval:
+            return 0
+
+        batch = self.queue[: self.batchSize]
+        client.publish(self.topic, json.dumps({"dropped": self.dropped, "records": batch}))
+        del self.queue[: len(batch)]
+        self.dropped = 0
+        self.lastSent = time.ticks_ms()
+        return len(batch)
+
+
 class Formatter:
+    """The format is compiled once into a positional format and the record
+    attributes it uses, so formatting a record needs no lookups by name."""
+
     def __init__(self, fmt=None, datefmt=None):
         self.fmt = _default_fmt if fmt is None else fmt
         self.datefmt = _default_datefmt if datefmt is None else datefmt
+        self._usesTime = "asctime" in self.fmt
+        self._fmt, self._keys = _compile(self.fmt)
+        self._default = self.fmt == _default_fmt
 
     def usesTime(self):
-        return "asctime" in self.fmt
+        return self._usesTime
 
     def formatTime(self, datefmt, record):
         if hasattr(time, "strftime"):
@@ -93,63 +245,99 @@ class Formatter:
         return None
 
     def format(self, record):
-        if self.usesTime():
+        if self._default:
+            return "%s:%s:%s" % (record.levelname, record.name, record.message)
+        if self._usesTime:
             record.asctime = self.formatTime(self.datefmt, record)
-        return self.fmt % {
-            "name": record.name,
-            "message": record.message,
-            "msecs": record.msecs,
-            "asctime": record.asctime,
-            "levelname": record.levelname,
-        }
+        return self._fmt % tuple([getattr(record, key) for key in self._keys])
+
+
+def _compile(fmt):
+    """Turns "%(name)s" style fields into "%s" along with the list of names."""
+    parts = []
+    keys = []
+    i = 0
+    while True:
+        j = fmt.find("%(", i)
+        if j < 0:
+            parts.append(fmt[i:])
+            break
+        end = fmt.index(")", j)
+        parts.append(fmt[i : j + 1])
+        keys.append(fmt[j + 2 : end])
+        i = end + 1
+    return "".join(parts), keys
 
 
 class Logger:
+    """The effective level is cached whenever a level changes, a call below it
+    costs a single compare. The message is only formatted with its % style
+    args once a record is emitted."""
+
     def __init__(self, name, level=NOTSET):
         self.name = name
         self.level = level
+        self.effective = _DEFAULT_LEVEL
         self.handlers = []
         self.record = LogRecord()
+        self.updateLevel()
 
     def setLevel(self, level):
         self.level = level
+        if self.name == "root":
+            for logger in _loggers.values():
+                logger.updateLevel()
+        else:
+            self.updateLevel()
+
+    def updateLevel(self):
+        root = _loggers.get("root")
+        self.effective = self.level or (root.level if root else 0) or _DEFAULT_LEVEL
 
     def isEnabledFor(self, level):
-        return level >= self.getEffectiveLevel()
+        return level >= self.effective
 
     def getEffectiveLevel(self):
-        return self.level or getLogger().level or _DEFAULT_LEVEL
+        return self.effective
 
     def log(self, level, msg, *args):
-        if self.isEnabledFor(level):
-            if args:
-                if isinstance(args[0], dict):
-                    args = args[0]
-                msg = msg % args
-            self.record.set(self.name, level, msg)
-            handlers = self.handlers
-            if not handlers:
-                handlers = getLogger().handlers
-            for h in handlers:
-                h.emit(self.record)
+        if level >= self.effective:
+            self._log(level, msg, args)
+
+    def _log(self, level, msg, args):
+        if args:
+            if len(args) == 1 and isinstance(args[0], dict):
+                args = args[0]
+            msg = msg % args
+        self.record.set(self.name, level, msg)
+        handlers = self.handlers
+        if not handlers:
+            handlers = getLogger().handlers
+        for h in handlers:
+            h.emit(self.record)
 
     def debug(self, msg, *args):
-        self.log(DEBUG, msg, *args)
+        if DEBUG >= self.effective:
+            self._log(DEBUG, msg, args)
 
     def info(self, msg, *args):
-        self.log(INFO, msg, *args)
+        if INFO >= self.effective:
+            self._log(INFO, msg, args)
 
     def warning(self, msg, *args):
-        self.log(WARNING, msg, *args)
+        if WARNING >= self.effective:
+            self._log(WARNING, msg, args)
 
     def error(self, msg, *args):
-        self.log(ERROR, msg, *args)
+        if ERROR >= self.effective:
+            self._log(ERROR, msg, args)
 
     def critical(self, msg, *args):
-        self.log(CRITICAL, msg, *args)
+        if CRITICAL >= self.effective:
+            self._log(CRITICAL, msg, args)
 
     def exception(self, msg, *args):
-        self.log(ERROR, msg, *args)
+        self.error(msg, *args)
         if hasattr(sys, "exc_info"):
             sys.print_exception(sys.exc_info()[1], _stream)
 
@@ -4,13 +4,27 @@ import machine
 import dht
 import network
 import time
+import uasyncio as asyncio
 from umqtt.simple import MQTTClient
-import onewire, ds18x20
 import gc
+import logging
+from array import array
 
 from ntptime import ntptime
+from clock import Clock
 from scd30 import SCD30
-from boot import CFG, sta_if, connect_wifi, logger
+from ds18b20 import DS18B20
+from moisture import Moisture
+from spool import Spool
+from batch import Batch
+from rtcstate import RTCState, PENDING_MAX_BYTES
+from aggregate import Aggregator, STATS
+from session import Client, Session
+import telemetry
+import ugit
+import config
+from config import CFG
+from boot import sta_if, connect_wifi, logger
 
 # Global settings from config file.
 #
@@ -19,7 +33,7 @@ SSID = CFG["Network"]["SSID"]
 PASS = CFG["Network"]["PASS"]
 # Device Settings
 DEVICE_ID = int.from_bytes(machine.unique_id(), "little")
-THING_NAME = f"{CFG["AWS_IOT_core"]["THING_NAME"]}_{str(DEVICE_ID)}"
+THING_NAME = f"{CFG['AWS_IOT_core']['THING_NAME']}_{str(DEVICE_ID)}"
 # Publishing Topics
 PUB_TOPIC = CFG["AWS_IOT_core"]["TOPIC"]
 # Subscription Topics
@@ -30,6 +44,8 @@ SUB_TOPIC = "ESP32/all/update/ota"
 SUB_TOPIC_CONFIG = f"ESP32/{THING_NAME}/update/config"
 SUB_TOPIC_OTA = f"ESP32/{THING_NAME}/update/ota"
 SUB_TOPIC_CERTS = f"ESP32/{THING_NAME}/update/certs"
+# Warnings and errors of the device.
+PUB_TOPIC_LOG = f"ESP32/{THING_NAME}/log"
 # AWS Server Endpoint.
 ENDPOINT = CFG["AWS_IOT_core"]["ENDPOINT"]
 # AWS Certificates.
@@ -39,44 +55,183 @@ PRIVATE_KEY = open(CFG["AWS_IOT_core"]["PRIVATE_KEY"], "r").read()
 SSL_CONFIG = {"key": PRIVATE_KEY, "cert": CERTIFICATE, "server_side": False}
 
 # General Settings
-TIME_INTERVAL = CFG["Device_settings"]["Time_Interval"]
 DEVICE_LOCATION = CFG["Device_settings"]["location"]
 UTC_OFFSET = CFG["Device_settings"]["UTC_Offset"]
-
-# Sensor flags for whether a specific sensor is used.
-SCD30_BOOLEAN = CFG["Sensors"]["SCD30"]["Boolean"]
-MOISTURE_BOOLEAN = CFG["Sensors"]["Moisture_Sensor"]["Boolean"]
-DS18B20_BOOLEAN = CFG["Sensors"]["DS18B20"]["Boolean"]
-AM2302_BOOLEAN = CFG["Sensors"]["AM2302"]["Boolean"]
+# Wire format of the published data, either "json" or "binary" (see telemetry.py).
+ENCODING = CFG["Device_settings"]["Encoding"]
 
 # Sets which pins are used by the sensors. Each sensor uses a different number of pins.
 SCD30_PIN = CFG["Sensors"]["SCD30"]["Pin"]
-# MOISTURE_PIN = CFG["Sensors"]["Moisture_Sensor"]["Pin"]
+# Use the hardware I2C peripheral instead of bit banging, at the given clock in Hz.
+SCD30_HARDWARE_I2C = CFG["Sensors"]["SCD30"]["Hardware_I2C"]
+SCD30_FREQUENCY = CFG["Sensors"]["SCD30"]["Frequency"]
+# Maximum time in ms to wait for a measurement of the SCD30.
+SCD30_READY_TIMEOUT = CFG["Sensors"]["SCD30"]["Ready_Timeout"]
+# Pin connected to the RDY output of the SCD30, null to poll the status over I2C.
+SCD30_RDY_PIN = CFG["Sensors"]["SCD30"]["RDY_Pin"]
+MOISTURE_PIN = CFG["Sensors"]["Moisture_Sensor"]["Pin"]
 DS18B20_PIN = CFG["Sensors"]["DS18B20"]["Pin"]
 AM2302_PIN = CFG["Sensors"]["AM2302"]["Pin"]
 
+# Oversampling of the moisture sensors, filtered by "median" or "trimmed_mean".
+MOISTURE_SAMPLES = CFG["Sensors"]["Moisture_Sensor"]["Samples"]
+MOISTURE_FILTER = CFG["Sensors"]["Moisture_Sensor"]["Filter"]
+# Raw ADC values of each channel at the dry and the wet point.
+MOISTURE_CALIBRATION = CFG["Sensors"]["Moisture_Sensor"]["Calibration"]
+
 # Defines the Sensor names.
 DS18B20_NAME = CFG["Sensors"]["DS18B20"]["Name"]
+
+# Maps hex ROM codes to names for several DS18B20 on the same pin.
+DS18B20_ROM_NAMES = CFG["Sensors"]["DS18B20"]["ROM_Names"]
+# File the ROM codes found are cached in across reboots.
+DS18B20_ROM_CACHE = CFG["Sensors"]["DS18B20"]["ROM_Cache"]
+# Resolution of the DS18B20 in bits (9 - 12). Each bit less halves the conversion time.
+DS18B20_RESOLUTION = min(max(CFG["Sensors"]["DS18B20"]["Resolution"], 9), 12)
+
+# Store and forward queue for readings that could not be published.
+SPOOL_FILE = CFG["Store_and_forward"]["File"]
+SPOOL_RECORDS = CFG["Store_and_forward"]["Records"]
+# Bytes per slot, readings larger than a slot span several of them.
+SPOOL_RECORD_SIZE = CFG["Store_and_forward"]["Record_Size"]
+# Maximum number of queued readings sent per cycle once the broker is reachable.
+SPOOL_DRAIN_RATE = CFG["Store_and_forward"]["Drain_Rate"]
+
+# Sample every Sample_Interval seconds and publish a summary of the window
+# every Time_Interval seconds. Not used in deep sleep mode.
+AGGREGATION_BOOLEAN = CFG["Aggregation"]["Boolean"]
+AGGREGATION_SAMPLE_INTERVAL = CFG["Aggregation"]["Sample_Interval"]
+AGGREGATION_MAX_FIELDS = CFG["Aggregation"]["Max_Fields"]
+
+# Deep sleep between readings for battery powered devices.
+DEEPSLEEP_BOOLEAN = CFG["Deep_sleep"]["Boolean"]
+# Seconds between NTP syncs, the RTC keeps running during deep sleep.
+DEEPSLEEP_NTP_RESYNC = CFG["Deep_sleep"]["NTP_Resync"]
+# Seconds to wait for the network after waking up.
+DEEPSLEEP_WIFI_TIMEOUT = CFG["Deep_sleep"]["WiFi_Timeout"]
+
+# NTP servers tried in order, seconds between syncs and socket timeout.
+NTP_HOSTS = CFG["NTP"]["Hosts"]
+NTP_RESYNC = CFG["NTP"]["Resync"]
+NTP_TIMEOUT = CFG["NTP"]["Timeout"]
+ntptime.host = NTP_HOSTS[0]
+ntptime.fallback = NTP_HOSTS[1:]
+ntptime.timeout = NTP_TIMEOUT
+
+# Log file on flash, at most Backups older segments of Max_Bytes are kept.
+# Records are written in batches, errors and above right away. Empty disables it.
+LOG_FILE = CFG["Logging"]["File"]
+LOG_MAX_BYTES = CFG["Logging"]["Max_Bytes"]
+LOG_BACKUPS = CFG["Logging"]["Backups"]
+LOG_FLUSH_INTERVAL = CFG["Logging"]["Flush_Interval"]
+# Warnings and above are queued, at most Capacity of them, and published in
+# batches of Batch_Size every Interval seconds on PUB_TOPIC_LOG.
+LOG_REMOTE_BOOLEAN = CFG["Logging"]["Remote"]["Boolean"]
+LOG_REMOTE_CAPACITY = CFG["Logging"]["Remote"]["Capacity"]
+LOG_REMOTE_BATCH_SIZE = CFG["Logging"]["Remote"]["Batch_Size"]
+LOG_REMOTE_INTERVAL = CFG["Logging"]["Remote"]["Interval"]
+
+# MQTT keepalive and reconnect backoff in seconds. The board is reset once the
+# broker was unreachable for Watchdog seconds.
+SESSION_KEEPALIVE = CFG["Session"]["Keepalive"]
+SESSION_BACKOFF = CFG["Session"]["Backoff"]
+SESSION_MAX_BACKOFF = CFG["Session"]["Max_Backoff"]
+SESSION_WATCHDOG = CFG["Session"]["Watchdog"]
+# QoS of the published readings. With QoS 1 at most Inflight messages wait for
+# their PUBACK, they are sent again after Retransmit seconds without one.
+SESSION_QOS = CFG["Session"]["QoS"]
+SESSION_INFLIGHT = CFG["Session"]["Inflight"]
+SESSION_RETRANSMIT = CFG["Session"]["Retransmit"]
 #
 # Process Parameters
 RETRY = 10
-# 
-PUB_RETRY = 3
+# Milliseconds between checks for incoming messages.
+RECEIVE_INTERVAL = 50
+# Seconds between housekeeping runs (reconnects, draining the spool, NTP, gc).
+HOUSEKEEPING_INTERVAL = 5
+
+
+def load_settings() -> None:
+    """Read the settings which can be changed at runtime via SUB_TOPIC_CONFIG.
+    The SCD30 offsets are read from CFG with every reading."""
+    global TIME_INTERVAL, SCD30_BOOLEAN, MOISTURE_BOOLEAN, DS18B20_BOOLEAN, AM2302_BOOLEAN
+    global BATCH_BOOLEAN, BATCH_SIZE, BATCH_WINDOW, BATCH_MAX_BYTES
+    global DEADBAND_BOOLEAN, DEADBAND_THRESHOLDS, DEADBAND_DEFAULT, DEADBAND_HEARTBEAT
+    TIME_INTERVAL = CFG["Device_settings"]["Time_Interval"]
+
+    # Sensor flags for whether a specific sensor is used.
+    SCD30_BOOLEAN = CFG["Sensors"]["SCD30"]["Boolean"]
+    MOISTURE_BOOLEAN = CFG["Sensors"]["Moisture_Sensor"]["Boolean"]
+    DS18B20_BOOLEAN = CFG["Sensors"]["DS18B20"]["Boolean"]
+    AM2302_BOOLEAN = CFG["Sensors"]["AM2302"]["Boolean"]
+
+    # Batching of several readings into one message.
+    BATCH_BOOLEAN = CFG["Batching"]["Boolean"]
+    BATCH_SIZE = CFG["Batching"]["Size"]
+    if ENCODING == "binary":
+        # The binary format counts the samples in a single byte.
+        BATCH_SIZE = min(BATCH_SIZE, 255)
+    BATCH_WINDOW = CFG["Batching"]["Window"]
+    # AWS IoT Core rejects messages above 128 KB, keep well below to spare the heap.
+    BATCH_MAX_BYTES = min(CFG["Batching"]["Max_Bytes"], 128 * 1024)
+    if DEEPSLEEP_BOOLEAN:
+        # The batch is kept in RTC memory during deep sleep.
+        BATCH_MAX_BYTES = min(BATCH_MAX_BYTES, PENDING_MAX_BYTES)
+
+    # Only publish when a field moved by more than its threshold, or at least
+    # every Heartbeat seconds. Fields without threshold use Default, null ignores them.
+    DEADBAND_BOOLEAN = CFG["Deadband"]["Boolean"]
+    DEADBAND_THRESHOLDS = CFG["Deadband"]["Thresholds"]
+    DEADBAND_DEFAULT = CFG["Deadband"]["Default"]
+    DEADBAND_HEARTBEAT = CFG["Deadband"]["Heartbeat"]
+
+
+load_settings()
+
+# Collects the readings into one message while batching is on, see build_payload.
+batch = None
+# Summarises the samples of a publishing interval while aggregation is on.
+aggregator = None
+
+# Millisecond time of the readings, corrected for the drift of the RTC.
+clock = Clock(DEEPSLEEP_NTP_RESYNC if DEEPSLEEP_BOOLEAN else NTP_RESYNC)
+
+log_handler = None
+if LOG_FILE:
+    log_handler = logging.RotatingFileHandler(
+        LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, flushInterval=LOG_FLUSH_INTERVAL * 1000
+    )
+    log_handler.setFormatter(logging.Formatter())
+    logging.getLogger().addHandler(log_handler)
+
+remote_log = None
+if LOG_REMOTE_BOOLEAN:
+    remote_log = logging.MQTTHandler(
+        PUB_TOPIC_LOG,
+        logging.WARNING,
+        LOG_REMOTE_CAPACITY,
+        LOG_REMOTE_BATCH_SIZE,
+        LOG_REMOTE_INTERVAL * 1000,
+        epochOffset=telemetry.EPOCH_OFFSET,
+    )
+    remote_log.setFormatter(logging.Formatter())
+    logging.getLogger().addHandler(remote_log)
 
 
 def log_message(msg: str) -> None:
-    """Write log messages to file."""
-    with open("log.txt", "a"):
-        logfile.write(msg)
+    """Write log messages to file, along with the console."""
+    logger.info(msg)
 
 
-def get_datetime():
+def get_datetime(timestamp: int = None):
     """Returns a readable date and time.
     This way, one does not need to solely rely upon the timestamp."""
     # Need to update this so it pulls the time from the internet connection.
     offset = UTC_OFFSET * 60**2
+    if timestamp is None:
+        timestamp = time.time()
     try: 
-        year, month, day, hour, mins, secs, _, _ = time.localtime(time.time() + offset)
+        year, month, day, hour, mins, secs, _, _ = time.localtime(timestamp + offset)
     except:
         year, month, day, hour, mins, secs, _, _ = 0, 0, 0, 0, 0, 0
 
@@ -90,44 +245,77 @@ def get_datetime():
 def message_callback(b_topic: str, b_msg: str) -> None:
     """Callback for MQTT client."""
     # Decoding the subscription message.
-    msg = json.loads(b_msg)
     topic = b_topic.decode("utf-8")
+    try:
+        msg = json.loads(b_msg)
+    except ValueError:
+        logger.warning("Ignored malformed message via topic %s.", topic)
+        return
 
-    logger.info(f"Received {msg} from mqtt broker via topic {topic}.")
+    logger.info("Received %s from mqtt broker via topic %s.", msg, topic)
 
-    if topic == SUB_TOPICS[0] or topic == SUB_TOPICS[1]:
+    if topic in SUB_TOPICS:
         if "update" in msg:
             if msg["update"]:
                 logger.info("\nPerforming a machine reset.\n")
                 # Perform a machine reset in order to trigger the ugit logic.
                 machine.reset()
+    elif topic == SUB_TOPIC_CONFIG:
+        apply_config(msg)
+
+
+def apply_config(changes: dict) -> None:
+    """Validate and persist a partial config and apply it without a reset.
+    Only the settings of config.LIVE are accepted, see load_settings."""
+    try:
+        config.update(changes)
+    except (ValueError, OSError) as e:
+        logger.warning("Rejected config update. %s", e)
+        return
+
+    load_settings()
+    if batch is not None:
+        batch.size = BATCH_SIZE
+        batch.window = BATCH_WINDOW
+        batch.max_bytes = BATCH_MAX_BYTES
+    if aggregator is not None and aggregator.size != aggregation_size():
+        try:
+            aggregator.resize(aggregation_size())
+        except MemoryError:
+            logger.error("No memory for %s samples per window. Kept %s.", aggregation_size(), aggregator.size)
+    logger.info("Applied config update %s", changes)
 
 
-def connect_iot_core() -> MQTTClient:
-    """Establish a connection AWS Iot Core MQTT broker."""
-    mqtt = MQTTClient(
+def connect_iot_core(retry: int = RETRY, reset: bool = True) -> MQTTClient:
+    """Establish a connection AWS Iot Core MQTT broker.
+    Returns None if no connection could be established and reset is not set."""
+    mqtt = Client(
         THING_NAME,
         ENDPOINT,
         port=8883,
-        keepalive=10000,
+        keepalive=SESSION_KEEPALIVE,
         ssl=True,
         ssl_params=SSL_CONFIG,
+        window=SESSION_INFLIGHT,
+        retransmit_ms=SESSION_RETRANSMIT * 1000,
     )
     if __debug__:
-        logger.debug(f"MQTT Client {mqtt.client_id} connects to {mqtt.server}.")
+        logger.debug("MQTT Client %s connects to %s.", mqtt.client_id, mqtt.server)
 
     mqtt.set_callback(message_callback)
     r = 0
     while True: 
         try:
             mqtt.connect()
-            logger.info(f"Established connection to MQTT broker at {ENDPOINT}.")
+            logger.info("Established connection to MQTT broker at %s.", ENDPOINT)
             break
         except Exception as e:
-            logger.error(f"Unable to connect to MQTT broker. {e}")
+            logger.error("Unable to connect to MQTT broker. %s", e)
             r = r + 1
-            if r == RETRY:
-                machine.reset()
+            if r == retry:
+                if reset:
+                    machine.reset()
+                return None
 
     # Subscribe to defined topics in order to be able to access the device.
     subscribe(mqtt)
@@ -135,10 +323,10 @@ def connect_iot_core() -> MQTTClient:
     return mqtt
 
 
-def data_from_AM2302():
+async def data_from_AM2302():
     """Connect to AM2302 sensor and return temperature and humidity."""
     if __debug__:
-        logger.debug(f"AM2302 Pin : {AM2302_PIN}")
+        logger.debug("AM2302 Pin : %s", AM2302_PIN)
 
     d = dht.DHT22(machine.Pin(AM2302_PIN))
 
@@ -153,144 +341,152 @@ def data_from_AM2302():
             break
         except:
             r = r + 1
-            time.sleep_ms(200) 
+            await asyncio.sleep_ms(200)
             logger.warning("Could not measure with AM2302. Retry.")
 
-    logger.info(f"AM2302: Temperature: {t} | Humidity: {h}")
+    logger.info("AM2302: Temperature: %s | Humidity: %s", t, h)
     return {"temperature": t, "humidity": h}
 
 
-def data_from_SCD30():
-    """Connect to SCD30 and return temperature, humidity, and co2."""
-    # Set up i2c protocol for the SCD30
-    i2c = machine.SoftI2C(scl=machine.Pin(SCD30_PIN[0]), sda=machine.Pin(SCD30_PIN[1]), freq=10000)
+# The SCD30 session is kept across cycles, so the bus is only scanned once.
+scd30 = None
+# co2, temperature and humidity, read into the same array every cycle.
+scd30_values = array("f", (0.0, 0.0, 0.0))
+
+
+def connect_SCD30() -> SCD30:
+    """Set up the i2c protocol and the session for the SCD30."""
+    scl = machine.Pin(SCD30_PIN[0])
+    sda = machine.Pin(SCD30_PIN[1])
+    # The SCD30 stretches the clock while it is busy, hence the long timeout in us.
+    if SCD30_HARDWARE_I2C:
+        i2c = machine.I2C(0, scl=scl, sda=sda, freq=SCD30_FREQUENCY, timeout=200000)
+    else:
+        i2c = machine.SoftI2C(scl=scl, sda=sda, freq=SCD30_FREQUENCY, timeout=200000)
+    return SCD30(i2c, 0x61, rdy_pin=SCD30_RDY_PIN)
 
-    try:
-        # If SCD30 has not been connected attempt to connect to it.
-        scd30 = SCD30(i2c, 0x61)
-    except:
-        logger.warning(
-            "Failed to connect to SCD30. Please make sure the sensor is connected."
-        )
+
+async def data_from_SCD30():
+    """Connect to SCD30 and return temperature, humidity, and co2."""
+    global scd30
+    start = time.ticks_ms()
+    if scd30 is None:
+        try:
+            # If SCD30 has not been connected attempt to connect to it.
+            scd30 = connect_SCD30()
+        except:
+            logger.warning(
+                "Failed to connect to SCD30. Please make sure the sensor is connected."
+            )
+    connected = time.ticks_ms()
 
     # scd30.set_forced_recalibration(CFG["Sensors"]["SCD30"]["CO2_Value"])
-    missingSCD30 = False
+    ready = connected
     # Try to take measurement from scd30
     try:
         # Wait until sensor has a measurement ready to be read
-        while scd30.get_status_ready() != 1:
-            time.sleep_ms(200)
-
-        # Take measurement from SCD30
-        (co2, temperature, humidity) = scd30.read_measurement()
-    except:
-        # If sensor is not connected use zeroes.
-        missingSCD30 = True
+        if await scd30.wait_ready_async(SCD30_READY_TIMEOUT):
+            ready = time.ticks_ms()
+            # Take measurement from SCD30
+            scd30.read_measurement_into(scd30_values)
+            (co2, temperature, humidity) = scd30_values
+        else:
+            logger.warning("No SCD30 measurement within %s ms.", SCD30_READY_TIMEOUT)
+            (co2, temperature, humidity) = (0.0, 0.0, 0.0)
+    except Exception as e:
+        # If sensor is not connected use zeroes and connect again next cycle.
+        logger.warning("Failed to read SCD30. %s", e)
+        scd30 = None
         (co2, temperature, humidity) = (0.0, 0.0, 0.0)
+    done = time.ticks_ms()
+
+    logger.info(
+        "SCD30 timings: connect %s ms | ready %s ms | read %s ms",
+        time.ticks_diff(connected, start),
+        time.ticks_diff(ready, connected),
+        time.ticks_diff(done, ready),
+    )
 
     # Add in offsets from config file
     co2 = co2 + CFG["SCD30_offsets"]["co2Offset"]
     temperature = temperature + CFG["SCD30_offsets"]["tempOffset"]
     humidity = humidity + CFG["SCD30_offsets"]["humidityOffset"]
 
-    logger.info(
-        f"SCD30: CO2: {co2} | Temperature: {temperature} | Humidity: {humidity}"
-    )
+    logger.info("SCD30: CO2: %s | Temperature: %s | Humidity: %s", co2, temperature, humidity)
 
     return {"temperature": temperature, "co2": co2, "humidity": humidity}
 
 
-def moisture_sensor_data():
-    """Gathers the data collected from any moisture sensors attached to the sensor."""
-    moisture1 = machine.ADC(machine.Pin(32))
-    moisture1.atten(machine.ADC.ATTN_11DB)
-
-    moisture2 = machine.ADC(machine.Pin(33))
-    moisture2.atten(machine.ADC.ATTN_11DB)
-
-    moisture3 = machine.ADC(machine.Pin(34))
-    moisture3.atten(machine.ADC.ATTN_11DB)
-
-    moisture4 = machine.ADC(machine.Pin(35))
-    moisture4.atten(machine.ADC.ATTN_11DB)
+# The ADC channels of the moisture sensors are kept across cycles.
+moisture_sensors = None
 
-    # Take measurements from Moisture Sensor
-    moistureValue1 = moisture1.read()
-    moistureValue2 = moisture2.read()
-    moistureValue3 = moisture3.read()
-    moistureValue4 = moisture4.read()
 
-    # Normalize moisture measurements to a percentage using the maximum
-    # sensor value, 4095.
-    #
-    # Immersing the sensor in water registers about 62% so it
-    # makes sense to set that as the 100% moisture point
-    moistureValue1 = 4095 - moistureValue1
-    moistureValue1 = moistureValue1 * (100 / 4095) * (100 / 63)
-
-    moistureValue2 = 4095 - moistureValue2
-    moistureValue2 = moistureValue2 * (100 / 4095) * (100 / 63)
-
-    moistureValue3 = 4095 - moistureValue3
-    moistureValue3 = moistureValue3 * (100 / 4095) * (100 / 63)
+def moisture_sensor_data():
+    """Gathers the data collected from any moisture sensors attached to the sensor."""
+    global moisture_sensors
+    if moisture_sensors is None:
+        moisture_sensors = Moisture(
+            MOISTURE_PIN, MOISTURE_CALIBRATION, MOISTURE_SAMPLES, MOISTURE_FILTER
+        )
 
-    moistureValue4 = 4095 - moistureValue4
-    moistureValue4 = moistureValue4 * (100 / 4095) * (100 / 63)
+    values = moisture_sensors.read()
 
     data = {}
-    # Add moisture measurements if they are not blank (Wired to 3.3Vcc).
-    if moistureValue1 > 1:
-        data["moisture_1"] = moistureValue1
-    if moistureValue2 > 1:
-        data["moisture_2"] = moistureValue2
-    if moistureValue3 > 1:
-        data["moisture_3"] = moistureValue3
-    if moistureValue4 > 1:
-        data["moisture_4"] = moistureValue4
+    for i in range(len(values)):
+        # Add moisture measurements if they are not blank (Wired to 3.3Vcc).
+        if values[i] > 1:
+            data[f"moisture_{i + 1}"] = values[i]
 
-    logger.info(
-        f"\nValues captured: \
-                Moisture 1: {moistureValue1} | \
-                Moisture 2: {moistureValue2} | \
-                Moisture 3: {moistureValue3} | \
-                Moisture 4: {moistureValue4}"
-    )
+    logger.info("Moisture values captured: %s", values)
     return data
 
 
-def data_from_DS18B20():
+# The DS18B20 buses are kept across cycles, so the ROM codes are only searched once.
+pipe_sensors = None
+
+
+async def data_from_DS18B20():
     """This method was built to measure the temperatures of the water
     coming into the farm from the roof."""
+    global pipe_sensors
     if __debug__:
-        logger.debug(f"DS18B20 Pin : {DS18B20_PIN}")
+        logger.debug("DS18B20 Pin : %s", DS18B20_PIN)
 
-    data = {}
-    for pin in range(0, len(DS18B20_PIN)):
-        try:
-            ds_pin = machine.Pin(DS18B20_PIN[pin])
-            ds_sensor = ds18x20.DS18X20(onewire.OneWire(ds_pin))
-
-            roms = ds_sensor.scan()
+    if pipe_sensors is None:
+        pipe_sensors = DS18B20(
+            DS18B20_PIN, DS18B20_NAME, DS18B20_ROM_NAMES, DS18B20_RESOLUTION, DS18B20_ROM_CACHE
+        )
 
-            ds_sensor.convert_temp()
-            time.sleep_ms(750)
-            data[DS18B20_NAME[pin]] = ds_sensor.read_temp(roms[0])
-        except:
-            try:
-                logger.error(f"{DS18B20_NAME[pin]} failed to respond.")
-            except:
-                logger.error("Unknown Pipe Sensor failed.")
+    # Start the conversion on all buses first, so they only wait for a single
+    # conversion window together.
+    for pin in pipe_sensors.convert():
+        ds18b20_failed(pin)
+    if not pipe_sensors.converting:
+        return {}
+
+    await asyncio.sleep_ms(pipe_sensors.conversion_ms)
+    data, failed = pipe_sensors.read()
+    for pin in failed:
+        ds18b20_failed(pin)
     return data
 
 
+def ds18b20_failed(pin: int) -> None:
+    """Log a DS18B20 that did not respond."""
+    try:
+        logger.error("%s failed to respond.", DS18B20_NAME[pin])
+    except:
+        logger.error("Unknown Pipe Sensor failed.")
+
+
 def subscribe(mqtt_client: MQTTClient) -> None:
     """Subscribe to all topics from MQTT broker."""
-    for topic in SUB_TOPICS:
+    for topic in SUB_TOPICS + [SUB_TOPIC_CONFIG]:
         try:
             mqtt_client.subscribe(topic)
-            logger.info(f"Subscribed to topic {topic}")
+            logger.info("Subscribed to topic %s", topic)
         except Exception as e:
-            logger.warning(f"Failed to subscribe to {topic}. {e}")
+            logger.warning("Failed to subscribe to %s. %s", topic, e)
 
 
 # def publish(mqtt_client: MQTTClient, topic: str, value: int) -> None:
@@ -304,76 +500,460 @@ def subscribe(mqtt_client: MQTTClient) -> None:
 
 def publish(mqtt_client: MQTTClient, topic: str, value: int) -> None:
     """Publish the data to the MQTT broker."""
-    mqtt_client.publish(topic, value)
-    logger.info(f"Published value {value} to topic '{topic}'")
- 
+    # Does not wait for the PUBACK with QoS 1.
+    mqtt_client.publish(topic, value, qos=SESSION_QOS)
+    logger.info("Published value %s to topic '%s'", value, topic)
 
-if __name__ == "__main__":
-    mqtt_client = connect_iot_core()
-    gc.enable()
-    
+
+async def collect_data() -> dict:
+    """Gather data from the sensors specified in the config."""
+    data = {}
+    if SCD30_BOOLEAN:
+        scd30_data = await data_from_SCD30()
+        data.update(scd30_data)
+    if MOISTURE_BOOLEAN:
+        moisture_data = moisture_sensor_data()
+        data.update(moisture_data)
+    if DS18B20_BOOLEAN:
+        ds18B20_data = await data_from_DS18B20()
+        data.update(ds18B20_data)
+    if AM2302_BOOLEAN:
+        am2302_data = await data_from_AM2302()
+        data.update(am2302_data)
+    return data
+
+
+def aggregation_size() -> int:
+    """Samples taken during a publishing interval, one window holds all of them."""
+    return int(TIME_INTERVAL // AGGREGATION_SAMPLE_INTERVAL) + 1
+
+
+async def aggregate(aggregator: Aggregator) -> dict:
+    """Sample every AGGREGATION_SAMPLE_INTERVAL seconds for TIME_INTERVAL seconds
+    and return the summary of the window."""
+    start = time.ticks_ms()
+    interval = int(AGGREGATION_SAMPLE_INTERVAL * 1000)
+    while True:
+        sampled = time.ticks_ms()
+        aggregator.add(await collect_data())
+        if time.ticks_diff(time.ticks_ms(), start) + interval > TIME_INTERVAL * 1000:
+            break
+        # Keep the pace regardless of how long the sensors took.
+        await asyncio.sleep_ms(max(0, interval - time.ticks_diff(time.ticks_ms(), sampled)))
+
+    data = aggregator.summary()
+    aggregator.clear()
+    return data
+
+
+# Last published value of every field and the time of publishing for the deadband.
+last_sent = {}
+last_sent_time = 0
+
+
+def deadband_threshold(name: str):
+    """Threshold of a field. The statistics of a window summary, e.g. co2_max,
+    share the one of their field."""
+    if name in DEADBAND_THRESHOLDS:
+        return DEADBAND_THRESHOLDS[name]
+    for suffix in STATS:
+        if name.endswith(suffix):
+            return DEADBAND_THRESHOLDS.get(name[: -len(suffix)], DEADBAND_DEFAULT)
+    return DEADBAND_DEFAULT
+
+
+def exceeds_deadband(data: dict) -> bool:
+    """Whether a field moved by more than its threshold since it was last published."""
+    for name, value in data.items():
+        threshold = deadband_threshold(name)
+        if threshold is None:
+            continue
+        if name not in last_sent or abs(value - last_sent[name]) > threshold:
+            return True
+    return False
+
+
+def report(data: dict, timestamp: int) -> bool:
+    """Whether the reading has to be published, the last sent values are updated if so."""
+    global last_sent_time
+    if timestamp - last_sent_time < DEADBAND_HEARTBEAT * 1000 and not exceeds_deadband(data):
+        if __debug__:
+            logger.debug("Reading within deadband, not published.")
+        return False
+
+    last_sent.clear()
+    last_sent.update(data)
+    last_sent_time = timestamp
+    return True
+
+
+def serialise(timestamp: int, data: dict):
+    """Encode a single reading taken at timestamp in ms in the configured wire format."""
+    if ENCODING == "binary":
+        warn_unmapped(data)
+        return telemetry.encode(DEVICE_ID, DEVICE_LOCATION, timestamp, [data])
+
+    reading = {
+        "datetime": get_datetime(timestamp // 1000),
+        "timestamp": unix_ms(timestamp),
+        "device_id": DEVICE_ID,
+        "location": DEVICE_LOCATION,
+    }
+    reading.update(data)
+    return json.dumps(reading)
+
+
+def serialise_batch(batch: Batch):
+    """Encode all samples of a batch in the configured wire format."""
+    if ENCODING == "binary":
+        for sample in batch.samples:
+            warn_unmapped(sample)
+        return telemetry.encode(DEVICE_ID, DEVICE_LOCATION, batch.start, batch.samples)
+    return batch.dumps(get_datetime(batch.start // 1000), unix_ms(batch.start))
+
+
+# Fields without an id in the binary schema, each is only warned about once.
+unmapped_fields = set()
+
+
+def warn_unmapped(sample: dict) -> None:
+    """Log the fields the binary encoding leaves out, e.g. ROM_Names or extra channels."""
+    for name in telemetry.unmapped(sample):
+        if name not in unmapped_fields:
+            unmapped_fields.add(name)
+            logger.warning("Field %s is not in telemetry.FIELDS, left out of the binary payload.", name)
+
+
+def unix_ms(timestamp: int) -> int:
+    """Converts ms of the device epoch to the unix epoch of the payloads."""
+    return timestamp + telemetry.EPOCH_OFFSET * 1000
+
+
+def queue(spool: Spool, payload, batch: Batch = None) -> None:
+    """Keep readings that could not be published on flash.
+    A batch is split into single readings, so each takes as few spool slots as possible."""
+    try:
+        if batch is None or not len(batch):
+            spool.push(payload)
+            return
+
+        for timestamp, reading in batch.readings():
+            spool.push(serialise(timestamp, reading))
+    except Spool.RecordTooLarge:
+        logger.error("Reading exceeds the spool of %s slots. Dropped.", SPOOL_RECORDS)
+    finally:
+        if batch is not None:
+            batch.clear()
+
+
+def requeue(spool: Spool, payloads: list) -> None:
+    """Keep the QoS 1 messages of a lost connection which were never acknowledged.
+    They were sent before anything still queued, so they go in front of it.
+    Batches are kept whole, they span as many spool slots as needed."""
+    for payload in reversed(payloads):
+        try:
+            spool.push_front(payload)
+        except Spool.RecordTooLarge:
+            logger.error("Reading exceeds the spool of %s slots. Dropped.", SPOOL_RECORDS)
+    logger.warning("Queued %s unacknowledged readings.", len(payloads))
+
+
+def drain(mqtt_client: MQTTClient, spool: Spool) -> None:
+    """Publish queued readings in order, at most SPOOL_DRAIN_RATE per call
+    and only as long as the QoS 1 window has room."""
+    n = 0
+    while len(spool) and n < SPOOL_DRAIN_RATE and not mqtt_client.window_full():
+        publish(mqtt_client, PUB_TOPIC, spool.peek())
+        # Only drop the reading once the broker accepted it. With QoS 1 it is
+        # kept in flight until the PUBACK and requeued if the connection dies.
+        spool.pop()
+        n = n + 1
+
+    if n:
+        logger.info("Sent %s queued readings, %s left.", n, len(spool))
+
+
+def disconnect(mqtt_client: MQTTClient) -> None:
+    """Close a broken connection to the MQTT broker."""
+    try:
+        mqtt_client.disconnect()
+    except:
+        pass
+
+
+def reconnect_wifi() -> None:
+    """Trigger a reconnect to the network without blocking."""
+    try:
+        sta_if.active(True)
+        sta_if.connect(SSID, PASS)
+    except Exception as e:
+        logger.warning("Reconnecting to network failed. %s", e)
+
+
+def wait_wifi(timeout: int) -> bool:
+    """Reconnect to the network and wait at most timeout seconds for it."""
+    if sta_if.isconnected():
+        return True
+
+    reconnect_wifi()
+    start = time.ticks_ms()
+    while not sta_if.isconnected():
+        if time.ticks_diff(time.ticks_ms(), start) > timeout * 1000:
+            logger.warning("No WIFI after %s seconds.", timeout)
+            return False
+        time.sleep_ms(100)
+    return True
+
+
+def set_time(retry: int = RETRY, reset: bool = True) -> bool:
+    """Sets the correct time otherwise the default of UNIX starting time is used as reference."""
     r = 0
     while True:
-        # Sets the correct time otherwise the default of UNIX starting time is used as reference.
         try:
-            ntptime.settime()
-            break
+            clock.sync()
+            logger.info(
+                "Time synced. Offset: %s ms | RTT: %s ms | Drift: %.1f ppm",
+                clock.offset,
+                clock.rtt,
+                clock.drift,
+            )
+            return True
         except:
             logger.warning("Setting current time failed.")
             r = r + 1
-            if r == RETRY:
-                machine.reset()
+            if r == retry:
+                if reset:
+                    machine.reset()
+                return False
             time.sleep(1)
 
-    # Set a time counter.
-    starting_time = time.time()
-    # Message counter
-    msg_c = 0
-    while True:
-        # Make sure WIFI still connected.
-        if sta_if.isconnected():
-            data = {
-                "datetime": get_datetime(),
-                "device_id": DEVICE_ID,
-                "location": DEVICE_LOCATION,
-            }
-            # Gather data from the sensor specified.
-            if SCD30_BOOLEAN:
-                scd30_data = data_from_SCD30()
-                data.update(scd30_data)
-            if MOISTURE_BOOLEAN:
-                moisture_data = moisture_sensor_data()
-                data.update(moisture_data)
-            if DS18B20_BOOLEAN:
-                ds18B20_data = data_from_DS18B20()
-                data.update(ds18B20_data)
-            if AM2302_BOOLEAN:
-                am2302_data = data_from_AM2302()
-                data.update(am2302_data)
-
-            try:
-                # Check for newly arrived messages via subscription topics
-                mqtt_client.check_msg()
-            except:
-                logger.warning("Receiving message from broker failed.")
-            
-            # As umqtt does not offer a simply still connected function this is they 
-            # way around it.
-            try:
-                # Push the data to the MQTT broker in AWS Iot Core.
-                publish(mqtt_client, PUB_TOPIC, json.dumps(data))
-                msg_c = 0
-            except:
-                logger.warning(f"Failed to publish to {PUB_TOPIC}. Retry {msg_c}.")
-                if msg_c == PUB_RETRY:
-                    logger.warning(f"Publishing to broker failed {PUB_RETRY} times. Machine reset next.")
-                    machine.reset()
-                msg_c = msg_c + 1
 
-            # Control the interval of publishing data.
-            time.sleep(TIME_INTERVAL)
-            gc.collect()
+def build_payload(timestamp: int, data: dict, batch: Batch = None):
+    """Encode a reading. Returns None while the batch is still collecting readings."""
+    if batch is None or (not BATCH_BOOLEAN and not len(batch)):
+        return serialise(timestamp, data)
+
+    batch.add(data, timestamp)
+    # Samples left over from turning batching off go out with this reading.
+    if not BATCH_BOOLEAN or batch.ready(clock.now_ms()):
+        return serialise_batch(batch)
+    return None
+
+
+def send(session: Session, spool: Spool, payload, batch: Batch = None) -> None:
+    """Publish the backlog and the payload or queue them on flash."""
+    # Handles incoming messages and detects a dead connection by MQTT pings.
+    if not session.poll():
+        if payload is not None:
+            queue(spool, payload, batch)
+        return
+
+    # A failed publish is taken as a dead connection as well.
+    mqtt_client = session.client
+    try:
+        if payload is not None and (len(spool) or mqtt_client.window_full()):
+            # Keep the order by sending the backlog first. A full QoS 1
+            # window queues the payload instead of waiting for PUBACKs.
+            queue(spool, payload, batch)
+            payload = None
+        drain(mqtt_client, spool)
+        if payload is not None:
+            # Push the data to the MQTT broker in AWS Iot Core.
+            publish(mqtt_client, PUB_TOPIC, payload)
+            if batch is not None:
+                batch.clear()
+    except Exception as e:
+        logger.warning("Failed to publish to %s. Queueing reading. %s", PUB_TOPIC, e)
+        if payload is not None:
+            queue(spool, payload, batch)
+        session.drop(e)
+
+
+def ship_logs(session: Session, spool: Spool) -> None:
+    """Publish a batch of the queued log records. Readings go first, so only
+    once the backlog is drained and with room in the QoS 1 window."""
+    mqtt_client = session.client
+    if remote_log is None or mqtt_client is None or len(spool) or mqtt_client.window_full():
+        return
+    try:
+        remote_log.send(mqtt_client)
+    except Exception as e:
+        session.drop(e)
+
+
+def duty_cycle(session: Session, spool: Spool, batch: Batch = None) -> None:
+    """Take a single reading and deep sleep until the next one.
+    Everything that has to survive the sleep is kept in RTC memory."""
+    global last_sent_time
+    state = RTCState()
+    if batch is not None:
+        state.restore(batch)
+    if state.sent:
+        last_sent_time, values = state.sent
+        last_sent.update(values)
+    if state.last_sync and clock.synced is None:
+        clock.restore(state.last_sync * 1000, state.drift)
+
+    timestamp = clock.now_ms()
+    data = asyncio.run(collect_data())
+
+    payload = None
+    # The latency changes every cycle, only the sensor fields count for the deadband.
+    if not DEADBAND_BOOLEAN or report(data, timestamp):
+        if state.latency:
+            data["wake_latency_ms"] = state.latency
+        payload = build_payload(timestamp, data, batch)
+    if payload is not None:
+        if session.client is None and wait_wifi(DEEPSLEEP_WIFI_TIMEOUT):
+            session.ensure(force=True)
+        if session.client is not None and clock.due():
+            set_time(retry=1, reset=False)
+
+        send(session, spool, payload, batch)
+        ship_logs(session, spool)
+        # Readings whose PUBACK is missing are queued on flash by the drop.
+        if session.client is not None and not session.flush(SESSION_RETRANSMIT * 1000):
+            session.drop("PUBACK missing before deep sleep.")
+        if session.client is not None:
+            # Ticks start at zero on wake up, hence they cover the whole duty cycle.
+            state.latency = time.ticks_ms()
+            logger.info("Wake to publish latency: %s ms.", state.latency)
+            disconnect(session.client)
+
+    state.seq = state.seq + 1
+    if clock.synced is not None:
+        state.last_sync = clock.synced // 1000
+        state.drift = clock.drift
+    state.sent = [last_sent_time, last_sent]
+    if not state.save(batch):
+        # Pending readings exceed the RTC memory, keep them on flash instead.
+        queue(spool, None, batch)
+        state.save(batch)
+
+    # Reaching deep sleep confirms a pending OTA update.
+    ugit.confirm()
+    if __debug__:
+        logger.debug("Deep sleep after cycle %s.", state.seq)
+    if log_handler is not None:
+        log_handler.flush()
+    sta_if.active(False)
+    machine.deepsleep(TIME_INTERVAL * 1000)
+
+
+async def sampler(outbox: list, ready, batch: Batch = None, aggregator: Aggregator = None) -> None:
+    """Task taking the readings and handing the payloads over to the publisher."""
+    while True:
+        start = time.ticks_ms()
+        if aggregator is None:
+            data = await collect_data()
         else:
-            # sta_if = connect_wifi()
-            logger.warning("No WIFI. Machine reset next.")
-            machine.reset()
+            # Takes TIME_INTERVAL seconds.
+            data = await aggregate(aggregator)
+        # Payload stays None while a batch is still collecting readings or
+        # the reading is within the deadband.
+        payload = None
+        timestamp = clock.now_ms()
+        if not DEADBAND_BOOLEAN or report(data, timestamp):
+            payload = build_payload(timestamp, data, batch)
+        if payload is not None:
+            outbox.append(payload)
+            ready.set()
+
+        # Control the interval of publishing data.
+        if aggregator is None:
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            await asyncio.sleep_ms(max(0, TIME_INTERVAL * 1000 - elapsed))
+
+
+async def publisher(session: Session, spool: Spool, outbox: list, ready, batch: Batch = None) -> None:
+    """Task publishing the payloads handed over by the sampler."""
+    while True:
+        await ready.wait()
+        ready.clear()
+        while outbox:
+            # Make sure WIFI and the broker are still connected.
+            session.ensure()
+            send(session, spool, outbox.pop(0), batch)
+
+
+async def receiver(session: Session) -> None:
+    """Task handling incoming messages, e.g. OTA triggers, within RECEIVE_INTERVAL ms."""
+    while True:
+        if session.client is not None:
+            session.poll()
+        await asyncio.sleep_ms(RECEIVE_INTERVAL)
+
+
+async def housekeeper(session: Session, spool: Spool) -> None:
+    """Task reconnecting, draining the backlog, resyncing the time and collecting the garbage."""
+    confirmed = False
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        session.ensure()
+        if not confirmed and session.client is not None:
+            # Running and connected, a pending OTA update is kept.
+            ugit.confirm()
+            confirmed = True
+        if log_handler is not None:
+            log_handler.poll()
+        if clock.due() and session.client is not None:
+            set_time(retry=1, reset=False)
+        if len(spool) and session.client is not None:
+            send(session, spool, None)
+        ship_logs(session, spool)
+        gc.collect()
+
+
+async def run(session: Session, spool: Spool, batch: Batch = None, aggregator: Aggregator = None) -> None:
+    """Runs sampling, publishing, receiving and housekeeping as cooperative tasks."""
+    outbox = []
+    ready = asyncio.Event()
+    asyncio.create_task(publisher(session, spool, outbox, ready, batch))
+    asyncio.create_task(receiver(session))
+    asyncio.create_task(housekeeper(session, spool))
+    await sampler(outbox, ready, batch, aggregator)
+
+
+if __name__ == "__main__":
+    # Woken up from deep sleep, the connections are only set up once there is
+    # something to publish.
+    woken = DEEPSLEEP_BOOLEAN and machine.reset_cause() == machine.DEEPSLEEP_RESET
+
+    # Readings that could not be published are kept on flash until the broker is back.
+    spool = Spool(SPOOL_FILE, SPOOL_RECORDS, SPOOL_RECORD_SIZE)
+    if len(spool):
+        logger.info("Found %s queued readings on flash.", len(spool))
+
+    # Reconnects to WIFI and the MQTT broker with backoff instead of resetting.
+    session = Session(
+        lambda: connect_iot_core(retry=1, reset=False),
+        sta_if,
+        SSID,
+        PASS,
+        SESSION_KEEPALIVE,
+        SESSION_BACKOFF,
+        SESSION_MAX_BACKOFF,
+        SESSION_WATCHDOG,
+        on_lost=lambda payloads: requeue(spool, payloads),
+    )
+    if not woken:
+        session.ensure(force=True)
+    gc.enable()
+
+    if not woken:
+        set_time()
+
+    # Created even with batching off, so it can be turned on via SUB_TOPIC_CONFIG.
+    header = {"device_id": DEVICE_ID, "location": DEVICE_LOCATION}
+    batch = Batch(header, BATCH_SIZE, BATCH_WINDOW, BATCH_MAX_BYTES)
+
+    if DEEPSLEEP_BOOLEAN:
+        duty_cycle(session, spool, batch)
+
+    aggregator = None
+    if AGGREGATION_BOOLEAN and AGGREGATION_SAMPLE_INTERVAL <= 0:
+        logger.error("Aggregation Sample_Interval must be positive. Aggregation disabled.")
+    elif AGGREGATION_BOOLEAN:
+        aggregator = Aggregator(aggregation_size(), AGGREGATION_MAX_FIELDS)
+
+    asyncio.run(run(session, spool, batch, aggregator))
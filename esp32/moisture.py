@@ -0,0 +1,70 @@
+"""Sensor"""
+from array import array
+import machine
+
+MEDIAN = "median"
+TRIMMED_MEAN = "trimmed_mean"
+
+# Raw reading of the capacitive sensors in air and immersed in water.
+# Immersing the sensor registers about 63% of the full scale of 4095.
+DEFAULT_CALIBRATION = (4095, 1515)
+
+
+class Moisture:
+    """Capacitive soil moisture sensors on the ADC pins.
+
+    Every reading takes samples raw values per channel and filters them by
+    median or trimmed mean, which drops a quarter on each side. The result is
+    scaled to a percentage between the dry and wet point of the channel.
+    """
+
+    def __init__(self, pins, calibration=None, samples=16, method=MEDIAN):
+        self.channels = []
+        for pin in pins:
+            adc = machine.ADC(machine.Pin(pin))
+            adc.atten(machine.ADC.ATTN_11DB)
+            self.channels.append(adc)
+        calibration = calibration or []
+        self.calibration = [
+            tuple(calibration[i]) if i < len(calibration) else DEFAULT_CALIBRATION
+            for i in range(len(pins))
+        ]
+        self.method = method
+        # Reused for the samples of every channel.
+        self.buf = array("H", [0] * max(samples, 1))
+
+    def read(self):
+        """Returns the moisture in percent for every channel."""
+        return [self.percentage(i, self.sample(i)) for i in range(len(self.channels))]
+
+    def sample(self, channel):
+        """Returns the filtered raw value of a channel."""
+        adc = self.channels[channel]
+        buf = self.buf
+        n = len(buf)
+        for i in range(n):
+            buf[i] = adc.read()
+        _sort(buf)
+
+        if self.method == TRIMMED_MEAN and n >= 4:
+            trim = n // 4
+            total = 0
+            for i in range(trim, n - trim):
+                total = total + buf[i]
+            return total / (n - 2 * trim)
+        return buf[n // 2]
+
+    def percentage(self, channel, raw):
+        dry, wet = self.calibration[channel]
+        return (dry - raw) * 100 / (dry - wet)
+
+
+def _sort(buf):
+    """Insertion sort in place, the sample count is small."""
+    for i in range(1, len(buf)):
+        value = buf[i]
+        j = i - 1
+        while j >= 0 and buf[j] > value:
+            buf[j + 1] = buf[j]
+            j = j - 1
+        buf[j + 1] = value
@@ -10,40 +10,106 @@ except:
 
 # The NTP host can be configured at runtime by doing: ntptime.host = 'myhost.org'
 host = "pool.ntp.org"
+# Hosts tried in order when host does not answer: ntptime.fallback = ['time.google.com']
+fallback = []
 # The NTP socket timeout can be configured at runtime by doing: ntptime.timeout = 2
 timeout = 1
 
+# Resolved addresses by host, a DNS lookup per sync is slow and may fail on its own.
+_addresses = {}
 
-def time():
+
+def _delta():
+    EPOCH_YEAR = utime.gmtime(0)[0]
+    if EPOCH_YEAR == 2000:
+        # (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+        return 3155673600
+    elif EPOCH_YEAR == 1970:
+        # (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
+        return 2208988800
+    raise Exception("Unsupported epoch: {}".format(EPOCH_YEAR))
+
+
+def _resolve(name):
+    addr = _addresses.get(name)
+    if addr is None:
+        addr = socket.getaddrinfo(name, 123)[0][-1]
+        _addresses[name] = addr
+    return addr
+
+
+def _us(seconds, fraction):
+    # NTP timestamps count the fraction of a second in 32 bits.
+    return seconds * 1000000 + ((fraction * 1000000) >> 32)
+
+
+def query(name):
+    """Ask a single server. Returns the time in ms of the epoch, the ticks_ms
+    it refers to and the round trip delay in ms without the server processing."""
     NTP_QUERY = bytearray(48)
     NTP_QUERY[0] = 0x1B
-    addr = socket.getaddrinfo(host, 123)[0][-1]
+    addr = _resolve(name)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.settimeout(timeout)
-        res = s.sendto(NTP_QUERY, addr)
+        sent = utime.ticks_us()
+        s.sendto(NTP_QUERY, addr)
         msg = s.recv(48)
+        received = utime.ticks_us()
+        ticks = utime.ticks_ms()
+    except:
+        # The address may have changed.
+        _addresses.pop(name, None)
+        raise
     finally:
         s.close()
-    val = struct.unpack("!I", msg[40:44])[0]
 
-    EPOCH_YEAR = utime.gmtime(0)[0]
-    if EPOCH_YEAR == 2000:
-        # (date(2000, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-        NTP_DELTA = 3155673600
-    elif EPOCH_YEAR == 1970:
-        # (date(1970, 1, 1) - date(1900, 1, 1)).days * 24*60*60
-        NTP_DELTA = 2208988800
-    else:
-        raise Exception("Unsupported epoch: {}".format(EPOCH_YEAR))
+    # Leap indicator 3 and stratum 0 mark an unsynchronised server or a kiss of death.
+    if msg[0] >> 6 == 3 or msg[1] == 0:
+        raise Exception("NTP server {} is not synchronised".format(name))
+    rx_s, rx_f, tx_s, tx_f = struct.unpack("!IIII", msg[32:48])
+    rx = _us(rx_s, rx_f)
+    tx = _us(tx_s, tx_f)
+    rtt = max(0, utime.ticks_diff(received, sent) - (tx - rx))
+    # The reply travelled about half of the round trip.
+    now = tx - _delta() * 1000000 + rtt // 2
+    return now // 1000, ticks, rtt // 1000
 
-    return val - NTP_DELTA
 
+def time_ms():
+    """Query host, then the fallback hosts until one answers.
+    Returns the result of query, the error of the last host if none answers."""
+    error = None
+    for name in [host] + list(fallback):
+        try:
+            return query(name)
+        except Exception as e:
+            error = e
+    raise error
 
-# There's currently no timezone support in MicroPython, and the RTC is set in UTC time.
-def settime():
-    t = time()
+
+def time():
+    t, ticks, rtt = time_ms()
+    return (t + utime.ticks_diff(utime.ticks_ms(), ticks)) // 1000
+
+
+def rtc_ms():
+    """Returns the time of the RTC in ms of the epoch."""
     import machine
 
-    tm = utime.gmtime(t)
-    machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+    y, mo, d, wd, h, mi, s, us = machine.RTC().datetime()
+    return utime.mktime((y, mo, d, h, mi, s, 0, 0)) * 1000 + us // 1000
+
+
+def setrtc(t):
+    """Set the RTC to t ms of the epoch."""
+    import machine
+
+    tm = utime.gmtime(t // 1000)
+    machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], (t % 1000) * 1000))
+
+
+# There's currently no timezone support in MicroPython, and the RTC is set in UTC time.
+def settime():
+    t, ticks, rtt = time_ms()
+    setrtc(t + utime.ticks_diff(utime.ticks_ms(), ticks))
@@ -0,0 +1,85 @@
+"""State Carried Across Deep Sleep"""
+import json
+import machine
+import struct
+
+# Magic, version, sequence counter, time of last NTP sync in seconds, wake to
+# publish latency in ms and the length of the json blob that follows.
+_HEADER = ">HBIIIH"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_MAGIC = 0x5455
+_VERSION = 4
+
+# The ESP32 port offers 2 KB of RTC user memory.
+RTC_MEMORY_SIZE = 2048
+# Space left for readings which are not yet published.
+PENDING_MAX_BYTES = 1280
+
+
+class RTCState:
+    """Counters, the last published reading and pending readings kept in RTC memory.
+
+    The RTC memory survives deep sleep but not a power cycle or hard reset,
+    an invalid or missing header yields a fresh state.
+    """
+
+    def __init__(self):
+        self.rtc = machine.RTC()
+        self.seq = 0
+        self.last_sync = 0
+        self.latency = 0
+        # RTC drift in ppm measured by the NTP syncs.
+        self.drift = 0.0
+        # Time and values of the last published reading for the deadband.
+        self.sent = None
+        self.pending = None
+        self.load()
+
+    def load(self):
+        mem = self.rtc.memory()
+        if len(mem) < _HEADER_SIZE:
+            return
+        magic, version, seq, last_sync, latency, length = struct.unpack_from(_HEADER, mem, 0)
+        if magic != _MAGIC or version != _VERSION:
+            return
+
+        self.seq = seq
+        self.last_sync = last_sync
+        self.latency = latency
+        try:
+            blob = json.loads(mem[_HEADER_SIZE : _HEADER_SIZE + length])
+            self.sent = blob["sent"]
+            self.pending = blob["pending"]
+            self.drift = blob["drift"]
+        except:
+            pass
+
+    def save(self, batch=None):
+        """Store the state along with the samples of batch.
+        Returns False if the samples do not fit, the state is saved without them then."""
+        saved = True
+        pending = None
+        if batch is not None and len(batch):
+            pending = [batch.start, batch.samples]
+
+        blob = {"sent": self.sent, "drift": self.drift, "pending": pending}
+        encoded = json.dumps(blob)
+        if _HEADER_SIZE + len(encoded) > RTC_MEMORY_SIZE:
+            blob["pending"] = None
+            encoded = json.dumps(blob)
+            saved = False
+
+        header = struct.pack(
+            _HEADER, _MAGIC, _VERSION, self.seq, self.last_sync, self.latency, len(encoded)
+        )
+        self.rtc.memory(header + encoded.encode("utf-8"))
+        return saved
+
+    def restore(self, batch):
+        """Add the pending samples of the last wake to batch."""
+        if not self.pending:
+            return
+        start, samples = self.pending
+        for sample in samples:
+            batch.add(sample, start + sample["offset"])
+        self.pending = None
@@ -1,5 +1,9 @@
 """Sensor"""
-from machine import I2C
+from machine import I2C, Pin
+from array import array
+import sys
+import uasyncio as asyncio
+import uctypes
 import utime
 import struct
 
@@ -35,272 +39,57 @@ class SCD30:
     #         crc = crc%256
     #     crc_table.append(crc)
 
-    CRC_TABLE = [
-        0,
-        49,
-        98,
-        83,
-        196,
-        245,
-        166,
-        151,
-        185,
-        136,
-        219,
-        234,
-        125,
-        76,
-        31,
-        46,
-        67,
-        114,
-        33,
-        16,
-        135,
-        182,
-        229,
-        212,
-        250,
-        203,
-        152,
-        169,
-        62,
-        15,
-        92,
-        109,
-        134,
-        183,
-        228,
-        213,
-        66,
-        115,
-        32,
-        17,
-        63,
-        14,
-        93,
-        108,
-        251,
-        202,
-        153,
-        168,
-        197,
-        244,
-        167,
-        150,
-        1,
-        48,
-        99,
-        82,
-        124,
-        77,
-        30,
-        47,
-        184,
-        137,
-        218,
-        235,
-        61,
-        12,
-        95,
-        110,
-        249,
-        200,
-        155,
-        170,
-        132,
-        181,
-        230,
-        215,
-        64,
-        113,
-        34,
-        19,
-        126,
-        79,
-        28,
-        45,
-        186,
-        139,
-        216,
-        233,
-        199,
-        246,
-        165,
-        148,
-        3,
-        50,
-        97,
-        80,
-        187,
-        138,
-        217,
-        232,
-        127,
-        78,
-        29,
-        44,
-        2,
-        51,
-        96,
-        81,
-        198,
-        247,
-        164,
-        149,
-        248,
-        201,
-        154,
-        171,
-        60,
-        13,
-        94,
-        111,
-        65,
-        112,
-        35,
-        18,
-        133,
-        180,
-        231,
-        214,
-        122,
-        75,
-        24,
-        41,
-        190,
-        143,
-        220,
-        237,
-        195,
-        242,
-        161,
-        144,
-        7,
-        54,
-        101,
-        84,
-        57,
-        8,
-        91,
-        106,
-        253,
-        204,
-        159,
-        174,
-        128,
-        177,
-        226,
-        211,
-        68,
-        117,
-        38,
-        23,
-        252,
-        205,
-        158,
-        175,
-        56,
-        9,
-        90,
-        107,
-        69,
-        116,
-        39,
-        22,
-        129,
-        176,
-        227,
-        210,
-        191,
-        142,
-        221,
-        236,
-        123,
-        74,
-        25,
-        40,
-        6,
-        55,
-        100,
-        85,
-        194,
-        243,
-        160,
-        145,
-        71,
-        118,
-        37,
-        20,
-        131,
-        178,
-        225,
-        208,
-        254,
-        207,
-        156,
-        173,
-        58,
-        11,
-        88,
-        105,
-        4,
-        53,
-        102,
-        87,
-        192,
-        241,
-        162,
-        147,
-        189,
-        140,
-        223,
-        238,
-        121,
-        72,
-        27,
-        42,
-        193,
-        240,
-        163,
-        146,
-        5,
-        52,
-        103,
-        86,
-        120,
-        73,
-        26,
-        43,
-        188,
-        141,
-        222,
-        239,
-        130,
-        179,
-        224,
-        209,
-        70,
-        119,
-        36,
-        21,
-        59,
-        10,
-        89,
-        104,
-        255,
-        206,
-        157,
-        172,
-    ]
-
-    def __init__(self, i2c, addr, pause=1000):
+    CRC_TABLE = (
+        b"\x00\x31\x62\x53\xc4\xf5\xa6\x97\xb9\x88\xdb\xea\x7d\x4c\x1f\x2e"
+        b"\x43\x72\x21\x10\x87\xb6\xe5\xd4\xfa\xcb\x98\xa9\x3e\x0f\x5c\x6d"
+        b"\x86\xb7\xe4\xd5\x42\x73\x20\x11\x3f\x0e\x5d\x6c\xfb\xca\x99\xa8"
+        b"\xc5\xf4\xa7\x96\x01\x30\x63\x52\x7c\x4d\x1e\x2f\xb8\x89\xda\xeb"
+        b"\x3d\x0c\x5f\x6e\xf9\xc8\x9b\xaa\x84\xb5\xe6\xd7\x40\x71\x22\x13"
+        b"\x7e\x4f\x1c\x2d\xba\x8b\xd8\xe9\xc7\xf6\xa5\x94\x03\x32\x61\x50"
+        b"\xbb\x8a\xd9\xe8\x7f\x4e\x1d\x2c\x02\x33\x60\x51\xc6\xf7\xa4\x95"
+        b"\xf8\xc9\x9a\xab\x3c\x0d\x5e\x6f\x41\x70\x23\x12\x85\xb4\xe7\xd6"
+        b"\x7a\x4b\x18\x29\xbe\x8f\xdc\xed\xc3\xf2\xa1\x90\x07\x36\x65\x54"
+        b"\x39\x08\x5b\x6a\xfd\xcc\x9f\xae\x80\xb1\xe2\xd3\x44\x75\x26\x17"
+        b"\xfc\xcd\x9e\xaf\x38\x09\x5a\x6b\x45\x74\x27\x16\x81\xb0\xe3\xd2"
+        b"\xbf\x8e\xdd\xec\x7b\x4a\x19\x28\x06\x37\x64\x55\xc2\xf3\xa0\x91"
+        b"\x47\x76\x25\x14\x83\xb2\xe1\xd0\xfe\xcf\x9c\xad\x3a\x0b\x58\x69"
+        b"\x04\x35\x66\x57\xc0\xf1\xa2\x93\xbd\x8c\xdf\xee\x79\x48\x1b\x2a"
+        b"\xc1\xf0\xa3\x92\x05\x34\x67\x56\x78\x49\x1a\x2b\xbc\x8d\xde\xef"
+        b"\x82\xb3\xe0\xd1\x46\x77\x24\x15\x3b\x0a\x59\x68\xff\xce\x9d\xac"
+    )
+
+    def __init__(self, i2c, addr, pause=1000, rdy_pin=None):
         self.i2c = i2c
         self.pause = pause
         self.addr = addr
         if not addr in i2c.scan():
             raise self.NotFoundException
 
+        # With the RDY output connected, new measurements are flagged by an
+        # interrupt instead of polling the status over I2C.
+        self.rdy = None
+        self._ready = False
+        if rdy_pin is not None:
+            self.rdy = rdy_pin if isinstance(rdy_pin, Pin) else Pin(rdy_pin, Pin.IN)
+            self.rdy.irq(trigger=Pin.IRQ_RISING, handler=self.__on_ready)
+            # A measurement may already be waiting, the edge has been missed then.
+            self._ready = self.rdy.value() == 1
+
+        # Preallocated buffers, so polling and reading do not allocate on the heap.
+        self._cmd = bytearray(2)
+        self._status = bytearray(3)
+        self._measurement = bytearray(18)
+        self._mv = memoryview(self._measurement)
+        self._values = array("f", (0.0, 0.0, 0.0))
+        self._values_ref = None
+        self._values_raw = None
+        # Positions of the big endian float bytes in the measurement (skipping
+        # the CRC bytes) in native byte order.
+        if sys.byteorder == "little":
+            self._order = (4, 3, 1, 0)
+        else:
+            self._order = (0, 1, 3, 4)
+
     def start_continous_measurement(self, ambient_pressure=0):
         bint = struct.pack(">H", ambient_pressure)
         crc = self.__crc(bint[0], bint[1])
@@ -319,22 +108,68 @@ class SCD30:
         return struct.unpack("BB", ver)
 
     def read_measurement(self):
-        measurement = self.__read_bytes(self.READ_MEASUREMENT, 18)
-        for i in range(0, len(measurement), 3):
-            self.__check_crc(measurement[i : i + 3])
-
-        value = measurement[0:]
-        co2 = struct.unpack(">f", value[0:2] + value[3:5])[0]
-        value = measurement[6:]
-        temperature = struct.unpack(">f", value[0:2] + value[3:5])[0]
-        value = measurement[12:]
-        relh = struct.unpack(">f", value[0:2] + value[3:5])[0]
-        return (co2, temperature, relh)
+        values = self._values
+        self.read_measurement_into(values)
+        return (values[0], values[1], values[2])
+
+    def read_measurement_into(self, values):
+        """Reads co2, temperature and humidity into values, an array("f") of three.
+        Only works on preallocated buffers, hence it does not allocate on the heap
+        once it was called with the same values before."""
+        if values is not self._values_ref:
+            # Byte view on the memory of values, created once per array.
+            self._values_raw = uctypes.bytearray_at(uctypes.addressof(values), 12)
+            self._values_ref = values
+
+        self._ready = False
+        self.__read_into(self.READ_MEASUREMENT, self._measurement)
+        mv = self._mv
+        for i in range(0, 18, 3):
+            self.__check_crc_at(mv, i)
+
+        raw = self._values_raw
+        order = self._order
+        for i in range(3):
+            for j in range(4):
+                raw[i * 4 + j] = mv[i * 6 + order[j]]
 
     def get_status_ready(self):
-        ready = self.__read_bytes(self.GET_STATUS_READY, 3)
-        self.__check_crc(ready)
-        return struct.unpack(">H", ready)[0]
+        ready = self._status
+        self.__read_into(self.GET_STATUS_READY, ready)
+        self.__check_crc_at(ready, 0)
+        return (ready[0] << 8) | ready[1]
+
+    def data_ready(self):
+        """Returns whether a new measurement is ready, without I2C traffic if RDY is connected."""
+        if self.rdy is not None:
+            return self._ready
+        return self.get_status_ready() == 1
+
+    def wait_ready(self, timeout_ms=3000, interval_ms=50, max_interval_ms=800):
+        """Poll the ready status with exponential backoff.
+        Returns False if no measurement became ready within timeout_ms."""
+        start = utime.ticks_ms()
+        if self.rdy is not None:
+            # Checking the flag is free, no need to back off.
+            interval_ms = max_interval_ms = 10
+        while not self.data_ready():
+            if utime.ticks_diff(utime.ticks_ms(), start) + interval_ms > timeout_ms:
+                return False
+            utime.sleep_ms(interval_ms)
+            interval_ms = min(interval_ms * 2, max_interval_ms)
+        return True
+
+    async def wait_ready_async(self, timeout_ms=3000, interval_ms=50, max_interval_ms=800):
+        """Same as wait_ready, but yields to other tasks while waiting."""
+        start = utime.ticks_ms()
+        if self.rdy is not None:
+            interval_ms = max_interval_ms = 10
+        while not self.data_ready():
+            if utime.ticks_diff(utime.ticks_ms(), start) + interval_ms > timeout_ms:
+                return False
+            await asyncio.sleep_ms(interval_ms)
+            interval_ms = min(interval_ms * 2, max_interval_ms)
+        return True
 
     def get_measurement_interval(self):
         bint = self.__read_bytes(self.SET_MEASURE_INTERVAL, 3)
@@ -391,8 +226,13 @@ class SCD30:
         data = bint + bytes([crc])
         self.i2c.writeto_mem(self.addr, self.SET_ALT_COMP, data, addrsize=16)
 
+    def __on_ready(self, pin):
+        self._ready = True
+
     def __write_command(self, cmd):
-        bcmd = struct.pack(">H", cmd)
+        bcmd = self._cmd
+        bcmd[0] = cmd >> 8
+        bcmd[1] = cmd & 0xFF
         self.i2c.writeto(self.addr, bcmd)
 
     def __read_bytes(self, cmd, count):
@@ -400,6 +240,15 @@ class SCD30:
         utime.sleep_us(self.pause)
         return self.i2c.readfrom(self.addr, count)
 
+    def __read_into(self, cmd, buf):
+        self.__write_command(cmd)
+        utime.sleep_us(self.pause)
+        self.i2c.readfrom_into(self.addr, buf)
+
+    def __check_crc_at(self, buf, i):
+        if self.__crc(buf[i], buf[i + 1]) != buf[i + 2]:
+            raise self.CRCException
+
     def __check_crc(self, arr):
         assert len(arr) == 3
         if self.__crc(arr[0], arr[1]) != arr[2]:
@@ -0,0 +1,265 @@
+"""MQTT Session Management"""
+import logging
+import machine
+import random
+import time
+from umqtt.simple import MQTTClient
+
+logger = logging.getLogger(__name__)
+
+
+class Client(MQTTClient):
+    """MQTTClient which notes the time of the last PINGRESP.
+
+    QoS 1 messages are not waited for. Up to window of them are kept in
+    flight by packet id until their PUBACK arrives with the next messages
+    checked, and retransmitted once they are unacknowledged for
+    retransmit_ms.
+    """
+
+    def __init__(self, *args, window=8, retransmit_ms=10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_pong = time.ticks_ms()
+        self.window = window
+        self.retransmit_ms = retransmit_ms
+        # Packet id -> [topic, msg, time sent]
+        self.inflight = {}
+
+    def window_full(self):
+        return len(self.inflight) >= self.window
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        if qos != 1:
+            return super().publish(topic, msg, retain, qos)
+        if self.window_full():
+            raise OSError("QoS 1 window full")
+
+        pid = self.pid
+        while True:
+            pid = pid % 0xFFFF + 1
+            if pid not in self.inflight:
+                break
+        self.pid = pid
+        self._send_publish(topic, msg, pid, retain, False)
+        self.inflight[pid] = [topic, msg, time.ticks_ms()]
+
+    def retransmit(self):
+        """Send the QoS 1 messages again which are not acknowledged in time."""
+        now = time.ticks_ms()
+        for pid, entry in self.inflight.items():
+            if time.ticks_diff(now, entry[2]) > self.retransmit_ms:
+                self._send_publish(entry[0], entry[1], pid, False, True)
+                entry[2] = now
+
+    def _send_publish(self, topic, msg, pid, retain, dup):
+        # PUBLISH with QoS 1, the same framing as in umqtt.simple.
+        pkt = bytearray(b"\x32\0\0\0")
+        pkt[0] |= retain | (dup << 3)
+        sz = 2 + len(topic) + len(msg) + 2
+        i = 1
+        while sz > 0x7F:
+            pkt[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        pkt[i] = sz
+        self.sock.write(pkt, i + 1)
+        self._send_str(topic)
+        pkt[0] = pid >> 8
+        pkt[1] = pid & 0xFF
+        self.sock.write(pkt, 2)
+        self.sock.write(msg)
+
+    def wait_msg(self):
+        res = self.sock.read(1)
+        self.sock.setblocking(True)
+        if res is None:
+            return None
+        if res == b"":
+            raise OSError(-1)
+        if res == b"\xd0":  # PINGRESP
+            sz = self.sock.read(1)[0]
+            assert sz == 0
+            self.last_pong = time.ticks_ms()
+            return None
+        if res == b"\x40":  # PUBACK
+            self.sock.read(1)
+            pid = self.sock.read(2)
+            self.inflight.pop(pid[0] << 8 | pid[1], None)
+            return 0x40
+        op = res[0]
+        if op & 0xF0 != 0x30:
+            return op
+        return self._recv_publish(op)
+
+    def _recv_publish(self, op):
+        # Same as in umqtt.simple.
+        sz = self._recv_len()
+        topic_len = self.sock.read(2)
+        topic_len = (topic_len[0] << 8) | topic_len[1]
+        topic = self.sock.read(topic_len)
+        sz -= topic_len + 2
+        if op & 6:
+            pid = self.sock.read(2)
+            pid = pid[0] << 8 | pid[1]
+            sz -= 2
+        msg = self.sock.read(sz)
+        self.cb(topic, msg)
+        if op & 6 == 2:
+            pkt = bytearray(b"\x40\x02\0\0")
+            pkt[2] = pid >> 8
+            pkt[3] = pid & 0xFF
+            self.sock.write(pkt)
+        elif op & 6 == 4:
+            assert 0
+        return op
+
+
+class Session:
+    """Keeps the connection to the MQTT broker alive.
+
+    A dead connection is detected by a failed operation or a PINGRESP which
+    did not arrive within half the keepalive. WiFi and MQTT are reconnected
+    with exponential backoff and jitter, connect is expected to subscribe to
+    the topics again. The board is only reset once the broker has been
+    unreachable for watchdog seconds.
+    """
+
+    def __init__(
+        self,
+        connect,
+        sta_if,
+        ssid,
+        password,
+        keepalive=300,
+        backoff=2,
+        max_backoff=300,
+        watchdog=3600,
+        on_lost=None,
+    ):
+        self.connect = connect
+        # Called with the unacknowledged QoS 1 messages of a dead connection.
+        self.on_lost = on_lost
+        self.sta_if = sta_if
+        self.ssid = ssid
+        self.password = password
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.watchdog = watchdog
+        self.client = None
+        self.failures = 0
+        self.next_attempt = time.ticks_ms()
+        self.last_ping = None
+        # Statistics of the reconnects. Ticks are used as the RTC may be set meanwhile.
+        self.reconnects = 0
+        self.downtime = 0
+        self.down_since = time.ticks_ms()
+        self.ever_connected = False
+
+    def ensure(self, force=False):
+        """Returns the client, reconnecting if the backoff allows or force is set.
+        Returns None while the broker is not reachable."""
+        if self.client is not None:
+            if self.sta_if.isconnected():
+                return self.client
+            self.drop("No WIFI.")
+
+        if time.ticks_diff(time.ticks_ms(), self.down_since) > self.watchdog * 1000:
+            # Last resort, nothing else helped for too long.
+            logger.error("No connection to the MQTT broker for %s s. Machine reset next.", self.watchdog)
+            machine.reset()
+        if not force and time.ticks_diff(self.next_attempt, time.ticks_ms()) > 0:
+            return None
+
+        if not self.sta_if.isconnected():
+            try:
+                self.sta_if.active(True)
+                self.sta_if.connect(self.ssid, self.password)
+            except Exception:
+                pass
+            # The WiFi connects in the background, MQTT follows on the next attempt.
+            self.__schedule()
+            return None
+
+        self.client = self.connect()
+        if self.client is None:
+            self.__schedule()
+            return None
+
+        down = time.ticks_diff(time.ticks_ms(), self.down_since) // 1000
+        if self.ever_connected:
+            self.reconnects = self.reconnects + 1
+            self.downtime = self.downtime + down
+            logger.info(
+                "Reconnected after %s s. Reconnects: %s | Downtime: %s s",
+                down,
+                self.reconnects,
+                self.downtime,
+            )
+        self.ever_connected = True
+        self.failures = 0
+        self.last_ping = None
+        self.client.last_pong = time.ticks_ms()
+        return self.client
+
+    def poll(self):
+        """Process incoming messages and ping the broker.
+        Returns False if the connection turned out to be dead."""
+        if self.client is None:
+            return False
+
+        try:
+            # Check for newly arrived messages via subscription topics, as
+            # well as PUBACKs of messages in flight.
+            while self.client.check_msg() is not None:
+                pass
+            self.client.retransmit()
+
+            now = time.ticks_ms()
+            half = self.keepalive * 500
+            if self.last_ping is not None:
+                if time.ticks_diff(self.client.last_pong, self.last_ping) >= 0:
+                    self.last_ping = None
+                elif time.ticks_diff(now, self.last_ping) > half:
+                    raise OSError("No PINGRESP within {} s".format(half // 1000))
+            if self.last_ping is None and time.ticks_diff(now, self.client.last_pong) > half:
+                self.client.ping()
+                self.last_ping = now
+        except Exception as e:
+            self.drop(e)
+            return False
+        return True
+
+    def flush(self, timeout_ms):
+        """Wait for the PUBACKs of the messages in flight.
+        Returns False if they did not arrive within timeout_ms."""
+        start = time.ticks_ms()
+        while self.client is not None and self.client.inflight:
+            if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                return False
+            if not self.poll():
+                return False
+            time.sleep_ms(10)
+        return self.client is not None
+
+    def drop(self, reason=None):
+        """Close a dead connection, the next reconnect is attempted right away."""
+        if self.client is None:
+            return
+        logger.warning("Connection to MQTT broker lost. %s", reason)
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+        if self.client.inflight and self.on_lost is not None:
+            self.on_lost([entry[1] for pid, entry in sorted(self.client.inflight.items())])
+        self.client = None
+        self.down_since = time.ticks_ms()
+        self.next_attempt = time.ticks_ms()
+
+    def __schedule(self):
+        # Exponential backoff, half of it as random jitter to spread a fleet.
+        delay = min(self.backoff * (1 << min(self.failures, 16)), self.max_backoff) * 1000
+        delay = delay // 2 + (random.getrandbits(16) * (delay // 2) >> 16)
+        self.next_attempt = time.ticks_add(time.ticks_ms(), delay)
+        self.failures = self.failures + 1
@@ -0,0 +1,191 @@
+"""Store and Forward Queue"""
+import os
+import struct
+
+# Every slot starts with the sequence number and the payload length.
+_HEADER = ">IH"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+# Length in the slots following the first one of a payload spanning several.
+_CONTINUED = 0xFFFF
+# First sequence number of a new file, the ones below are left for push_front.
+_SEQ_START = 1 << 16
+
+
+class Spool:
+    """Bounded ring buffer of unsent readings on flash.
+
+    The file consists of a fixed number of equally sized slots which are
+    written round robin, so the flash wears evenly. A payload larger than a
+    slot spans consecutive ones, the first holds the payload length and the
+    others are marked as continued. A first slot with a payload length of
+    zero is free. The queue state is recovered from the slot headers after
+    a reboot, hence no separate index file is needed.
+    """
+
+    class RecordTooLarge(Exception):
+        pass
+
+    def __init__(self, path, records=128, record_size=512):
+        self.path = path
+        self.records = records
+        self.record_size = record_size
+        self.capacity = record_size - _HEADER_SIZE
+        # Payloads queued and the slots they take.
+        self.count = 0
+        self.used = 0
+        self.head = 0
+        self.tail = 0
+        self.seq = 0
+        # Sequence number of the oldest payload.
+        self.first = 0
+        self.f = self.__open()
+        self.__recover()
+
+    def __len__(self):
+        return self.count
+
+    def push(self, payload):
+        """Append a payload, the oldest ones are dropped if the queue is full."""
+        payload = self.__prepare(payload)
+        n = self.__slots(len(payload))
+        while self.records - self.used < n:
+            self.pop()
+
+        self.seq = self.seq + 1
+        self.__write(self.head, self.seq, payload)
+        if not self.count:
+            self.first = self.seq
+        self.head = (self.head + n) % self.records
+        self.count = self.count + 1
+        self.used = self.used + n
+
+    def push_front(self, payload):
+        """Insert a payload before the oldest one, e.g. one that was sent but
+        never acknowledged. Being the oldest, it is dropped if the queue is full."""
+        payload = self.__prepare(payload)
+        if not self.count:
+            self.push(payload)
+            return
+        n = self.__slots(len(payload))
+        if self.records - self.used < n:
+            return
+        if self.first <= 1:
+            # No sequence number left below the oldest, e.g. in a file of an
+            # older version. Better late than lost.
+            self.push(payload)
+            return
+
+        self.tail = (self.tail - n) % self.records
+        self.first = self.first - 1
+        self.__write(self.tail, self.first, payload)
+        self.count = self.count + 1
+        self.used = self.used + n
+
+    def peek(self):
+        """Returns the oldest payload without removing it."""
+        if not self.count:
+            return None
+        self.f.seek(self.tail * self.record_size)
+        _, length = struct.unpack(_HEADER, self.f.read(_HEADER_SIZE))
+        if length <= self.capacity:
+            return self.f.read(length)
+
+        chunks = []
+        slot = self.tail
+        while length > 0:
+            self.f.seek(slot * self.record_size + _HEADER_SIZE)
+            chunks.append(self.f.read(min(length, self.capacity)))
+            length = length - self.capacity
+            slot = (slot + 1) % self.records
+        return b"".join(chunks)
+
+    def pop(self):
+        """Frees the slots of the oldest payload."""
+        if not self.count:
+            return
+        self.f.seek(self.tail * self.record_size)
+        _, length = struct.unpack(_HEADER, self.f.read(_HEADER_SIZE))
+        # Only the length is cleared, the sequence number stays to recover the head.
+        self.f.seek(self.tail * self.record_size + _HEADER_SIZE - 2)
+        self.f.write(b"\x00\x00")
+        self.f.flush()
+
+        n = self.__slots(length)
+        self.tail = (self.tail + n) % self.records
+        self.count = self.count - 1
+        self.used = self.used - n
+        if self.count:
+            self.f.seek(self.tail * self.record_size)
+            self.first = struct.unpack(_HEADER, self.f.read(_HEADER_SIZE))[0]
+
+    def close(self):
+        self.f.close()
+
+    def __prepare(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if self.__slots(len(payload)) > self.records:
+            raise self.RecordTooLarge
+        return payload
+
+    def __slots(self, length):
+        return max(1, (length + self.capacity - 1) // self.capacity)
+
+    def __write(self, slot, seq, payload):
+        # The first slot goes last, a crash in between leaves only continued
+        # slots without a first one, which are ignored.
+        mv = memoryview(payload)
+        for i in range(self.__slots(len(payload)) - 1, -1, -1):
+            self.f.seek((slot + i) % self.records * self.record_size)
+            self.f.write(struct.pack(_HEADER, seq, _CONTINUED if i else len(payload)))
+            self.f.write(mv[i * self.capacity : (i + 1) * self.capacity])
+        self.f.flush()
+
+    def __open(self):
+        size = self.records * self.record_size
+        try:
+            if os.stat(self.path)[6] == size:
+                return open(self.path, "r+b")
+        except OSError:
+            pass
+
+        # Preallocate all slots, so the file never grows during operation.
+        f = open(self.path, "w+b")
+        blank = bytes(self.record_size)
+        for _ in range(self.records):
+            f.write(blank)
+        f.flush()
+        return f
+
+    def __recover(self):
+        headers = []
+        for slot in range(self.records):
+            self.f.seek(slot * self.record_size)
+            headers.append(struct.unpack(_HEADER, self.f.read(_HEADER_SIZE)))
+
+        newest = None
+        for slot in range(self.records):
+            seq, length = headers[slot]
+            self.seq = max(self.seq, seq)
+            if length == _CONTINUED:
+                continue
+            if newest is None or seq > headers[newest][0]:
+                newest = slot
+            if length:
+                if not self.count or seq < self.first:
+                    self.first = seq
+                    self.tail = slot
+                self.count = self.count + 1
+                self.used = self.used + self.__slots(length)
+
+        if newest is not None and headers[newest][0]:
+            # The head follows the slots of the newest payload, even a freed one.
+            seq = headers[newest][0]
+            slot = (newest + 1) % self.records
+            while slot != newest and headers[slot] == (seq, _CONTINUED):
+                slot = (slot + 1) % self.records
+            self.head = slot
+        if not self.count:
+            self.tail = self.head
+        if not self.seq:
+            self.seq = _SEQ_START
@@ -0,0 +1,141 @@
+"""Binary Telemetry Encoding
+
+Compact alternative to the json payload. The same module decodes the
+messages on the host, hence it must only depend on struct and time.
+
+Layout (big endian):
+    header  version B | device_id Q | timestamp Q | location length B | location
+    samples count B (at most 255), per sample: offset I | field count B | (field id B | value i) * count
+
+The timestamp is the unix epoch of the first sample in ms, offsets are ms
+relative to it. Values are fixed point integers scaled by the factor in FIELDS.
+Since version 2 the upper three bits of the field id select the statistic of
+a window summary (see STATS). Up to version 2 timestamp (I) and offsets (H)
+were whole seconds, those messages decode unchanged.
+"""
+import struct
+import time
+
+SCHEMA_VERSION = 3
+
+# Field id (below 32), name, fixed point scale. Ids must never be reused for another name.
+FIELDS = (
+    (1, "temperature", 100),
+    (2, "humidity", 100),
+    (3, "co2", 10),
+    (4, "moisture_1", 100),
+    (5, "moisture_2", 100),
+    (6, "moisture_3", 100),
+    (7, "moisture_4", 100),
+    (8, "pipe_sensor_1", 100),
+    (9, "pipe_sensor_2", 100),
+    (10, "pipe_sensor_3", 100),
+    (11, "pipe_sensor_4", 100),
+    (12, "wake_latency_ms", 1),
+)
+
+# Name suffixes of the window statistics, the index is stored in the upper bits of the id.
+STATS = ("", "_min", "_max", "_mean", "_std")
+
+_BY_NAME = {}
+_BY_ID = {}
+for _fid, _name, _scale in FIELDS:
+    for _stat in range(len(STATS)):
+        _BY_NAME[_name + STATS[_stat]] = ((_stat << 5) | _fid, _scale)
+        _BY_ID[(_stat << 5) | _fid] = (_name + STATS[_stat], _scale)
+
+_HEADER = ">BQQB"
+_SAMPLE = ">IB"
+_FIELD = ">Bi"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_SAMPLE_SIZE = struct.calcsize(_SAMPLE)
+# Layout of the versions in whole seconds.
+_HEADER_V2 = ">BQIB"
+_SAMPLE_V2 = ">HB"
+_FIELD_SIZE = struct.calcsize(_FIELD)
+
+# MicroPython on the ESP32 counts from 2000-01-01, the payload from 1970-01-01.
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+
+def encode(device_id: int, location: str, timestamp: int, samples: list) -> bytearray:
+    """Encode samples taken from timestamp on in ms, the device epoch is converted to unix time.
+    Fields that are not part of the schema are left out."""
+    location = location.encode("utf-8")
+    size = _HEADER_SIZE + len(location) + 1
+    for sample in samples:
+        size = size + _SAMPLE_SIZE
+        for name in sample:
+            if name in _BY_NAME:
+                size = size + _FIELD_SIZE
+
+    buf = bytearray(size)
+    struct.pack_into(
+        _HEADER, buf, 0, SCHEMA_VERSION, device_id, timestamp + EPOCH_OFFSET * 1000, len(location)
+    )
+    pos = _HEADER_SIZE
+    buf[pos : pos + len(location)] = location
+    pos = pos + len(location)
+    buf[pos] = len(samples)
+    pos = pos + 1
+
+    for sample in samples:
+        start = pos
+        pos = pos + _SAMPLE_SIZE
+        count = 0
+        for name, value in sample.items():
+            if name not in _BY_NAME:
+                continue
+            fid, scale = _BY_NAME[name]
+            struct.pack_into(_FIELD, buf, pos, fid, int(round(value * scale)))
+            pos = pos + _FIELD_SIZE
+            count = count + 1
+        struct.pack_into(_SAMPLE, buf, start, sample.get("offset", 0), count)
+
+    return buf
+
+
+def unmapped(sample: dict) -> list:
+    """Names of the fields of sample which encode leaves out."""
+    return [name for name in sample if name not in _BY_NAME and name != "offset"]
+
+
+def decode(buf) -> dict:
+    """Decode a message into a dict with the samples as floats keyed by field name.
+    Timestamp and offsets are seconds, with ms as fraction since version 3."""
+    version = buf[0]
+    if not 1 <= version <= SCHEMA_VERSION:
+        raise ValueError("Unsupported schema version: {}".format(version))
+    header, layout, unit = _HEADER, _SAMPLE, 1000
+    if version < 3:
+        header, layout, unit = _HEADER_V2, _SAMPLE_V2, 1
+
+    version, device_id, timestamp, loc_len = struct.unpack_from(header, buf, 0)
+    if unit > 1:
+        timestamp = timestamp / unit
+    pos = struct.calcsize(header)
+    location = bytes(buf[pos : pos + loc_len]).decode("utf-8")
+    pos = pos + loc_len
+    count = buf[pos]
+    pos = pos + 1
+
+    samples = []
+    for _ in range(count):
+        offset, nfields = struct.unpack_from(layout, buf, pos)
+        pos = pos + struct.calcsize(layout)
+        sample = {"offset": offset / unit if unit > 1 else offset}
+        for _ in range(nfields):
+            fid, value = struct.unpack_from(_FIELD, buf, pos)
+            pos = pos + _FIELD_SIZE
+            # Ids of a newer schema revision are kept instead of failing.
+            name, scale = _BY_ID.get(fid, ("field_{}".format(fid), 1))
+            sample[name] = value / scale
+        samples.append(sample)
+
+    return {
+        "version": version,
+        "device_id": device_id,
+        "location": location,
+        "timestamp": timestamp,
+        "samples": samples,
+    }
@@ -2,6 +2,10 @@
 import os
 import urequests
 import json
+import hashlib
+import binascii
+import struct
+import zlib
 import machine
 import time
 import network
@@ -14,13 +18,25 @@ logging.basicConfig(level=logging.INFO)
 
 global internal_tree
 
-with open("configs/config.json", "r") as json_file:
-    CFG = json.load(json_file)
+
+def github_settings() -> dict:
+    """The Github section of the config, read on its own rather than via
+    config.py. That is updated by OTA and raises on a config it does not
+    validate, ugit has to roll back a bad update regardless."""
+    try:
+        with open("configs/config.json", "r") as json_file:
+            return json.load(json_file).get("Github", {})
+    except Exception as e:
+        logger.error(f"Failed to read the Github config. {e}")
+        return {}
+
+
+GITHUB = github_settings()
 
 # Repository must be public if no personal access token is supplied
-GITHUB_USER = CFG["Github"]["user"]
-GITHUB_REPO = CFG["Github"]["repo"]
-# REPO_ACCESS_TOKEN = open(CFG["Github"]["secret_access_token"], "r").read()
+GITHUB_USER = GITHUB.get("user", "")
+GITHUB_REPO = GITHUB.get("repo", "")
+# REPO_ACCESS_TOKEN = open(GITHUB["secret_access_token"], "r").read()
 REPO_ACCESS_TOKEN = ""
 
 # Specify the files that are uneffected by OTA updates.
@@ -40,28 +56,97 @@ IGNORE_FILES = [
 GIT_SUBFOLDER = "esp32/"
 GIT_TREE_URL = f"https://api.github.com/repos/{GITHUB_USER}/{GITHUB_REPO}/git/trees/main?recursive=1"
 GIT_RAW = f"https://raw.githubusercontent.com/{GITHUB_USER}/{GITHUB_REPO}/main/"
+# Git blob SHA of every file on the device that was pulled by OTA.
+MANIFEST = "ugit.json"
+# Files changed by the last update along with whether they existed before.
+# Kept until a boot confirms the update, otherwise the next boot rolls it back.
+PENDING = "ugit.pending"
+# Manifest of the last update rolled back, the same version is not pulled again.
+REJECTED = "ugit.rejected"
+# Seconds the first boot after an update has to confirm it, the board is reset otherwise.
+CONFIRM_TIMEOUT = GITHUB.get("Confirm_Timeout", 600)
+# Suffixes of the files being pulled and of the previous versions.
+TEMP = ".new"
+BACKUP = ".bak"
+# Bytes read from the socket at once, bounds the memory of a pull.
+CHUNK_SIZE = 1024
+# Path of the bundle built by build_bundle.py in the repo. With a bundle all
+# files are pulled with a single request, otherwise one by one.
+BUNDLE = GITHUB.get("Bundle", "")
+# Window of the bundle's zlib stream as a power of 2, bounds the memory of
+# the decompression. build_bundle.py compresses with the same.
+BUNDLE_WBITS = 10
+
+# Resets the board if the update is not confirmed in time.
+_confirm_timer = None
+# boot.py runs as a script and again when main.py imports it, ugit stays
+# loaded in between. Only the first run of a boot counts.
+_checked = False
 
 
-def pull(fpath: str, raw_url: str, headers: dict) -> None:
-    """Pulls a single file."""
+def pull(fpath: str, raw_url: str, headers: dict, size: int = None, sha: str = None) -> bool:
+    """Streams a single file into fpath + TEMP. Returns whether it was
+    received completely and matches size and git blob sha, if given."""
     r = urequests.get(raw_url, stream=True, headers=headers)
+    written = False
     try:
-        new_file = open(fpath, "w")
-        new_file.write(r.content.decode("utf-8"))
-        new_file.close()
+        if r.status_code != 200:
+            raise OSError(f"HTTP status {r.status_code}")
+        receive(r.raw, fpath, size, sha)
+        written = True
+    except Exception as e:
+        logger.error(f"Unable to pull {fpath}. {e}")
+        remove(fpath + TEMP)
 
-        logger.info(f"Updated {fpath} on device.")
-    except:
-        try:
+    r.close()
+    return written
+
+
+def receive(stream, fpath: str, size: int = None, sha: str = None) -> None:
+    """Streams size bytes, or everything if size is None, into fpath + TEMP.
+    Nothing is written if fpath is None. Raises if the bytes do not match
+    size and the git blob sha."""
+    digest = None
+    if sha is not None and size is not None:
+        # Git hashes the content along with a header.
+        digest = hashlib.sha1(f"blob {size}\0".encode())
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    n = 0
+    new_file = None
+    if fpath is not None:
+        make_dirs(fpath)
+        new_file = open(fpath + TEMP, "wb")
+    try:
+        while size is None or n < size:
+            k = stream.readinto(mv if size is None else mv[: min(CHUNK_SIZE, size - n)])
+            if not k:
+                break
+            if new_file is not None:
+                new_file.write(mv[:k])
+            if digest is not None:
+                digest.update(mv[:k])
+            n = n + k
+    finally:
+        if new_file is not None:
             new_file.close()
-        except:
-            logger.error(f"Unable to close {fpath} file during raw file decoding.")
 
-    r.close()
+    if size is not None and n != size:
+        raise OSError(f"Received {n} of {size} bytes")
+    if digest is not None and binascii.hexlify(digest.digest()).decode() != sha:
+        raise OSError("SHA mismatch")
+
+    if __debug__:
+        logger.debug(f"Received {fpath} with {n} bytes.")
 
 
-def update() -> None:
-    """Pulls all the files & overwrites updated files."""
+def update() -> int:
+    """Pulls the files whose blob SHA differs from the manifest and removes the
+    files deleted upstream. Returns the number of files changed.
+
+    All files are pulled to temporary files first, only if every one of them
+    is complete they are renamed into place. The previous versions are kept
+    until the next boot confirms the update, see boot_check and confirm."""
     logger.info("Updating device.")
 
     # Construct the header used for fetching from github.
@@ -73,56 +158,295 @@ def update() -> None:
     if __debug__:
         logger.debug(f"Header used for fetching data : {headers}.")
 
+    if exists(PENDING):
+        # Backups of an unconfirmed update must not be overwritten.
+        logger.warning("Previous update not confirmed yet, update skipped.")
+        return 0
+
+    manifest = load_manifest()
+    if BUNDLE:
+        fetched = pull_bundle(headers, manifest)
+    else:
+        fetched = pull_files(headers, manifest)
+    if fetched is None:
+        return 0
+    current, pulled = fetched
+
+    # Only files pulled before are removed, never the ones kept out of OTA.
+    removed = [fpath for fpath in manifest if fpath not in current and exists(fpath)]
+    if not pulled and not removed:
+        logger.info("Device is up to date.")
+        return 0
+
+    with open(MANIFEST + TEMP, "w") as f:
+        json.dump(current, f)
+    pulled.append(MANIFEST)
+
+    # Written first, so even an update cut short by a power loss is rolled back.
+    changes = {}
+    for fpath in pulled + removed:
+        changes[fpath] = exists(fpath)
+    save_pending({"boots": 0, "installed": False, "files": changes})
+
+    for fpath in pulled:
+        install(fpath)
+        logger.info(f"Updated {fpath} on device.")
+    for fpath in removed:
+        remove(fpath + BACKUP)
+        os.rename(fpath, fpath + BACKUP)
+        logger.info(f"Removed {fpath} from device.")
+    save_pending({"boots": 0, "installed": True, "files": changes})
+
+    changed = len(pulled) - 1 + len(removed)
+    logger.info(f"Update done, {changed} files changed.")
+    return changed
+
+
+def pull_files(headers: dict, manifest: dict) -> tuple:
+    """Pulls the changed files of the git tree one by one.
+    Returns the blob SHA by path of all files and the paths pulled, None on failure."""
     # Get the git tree
     tree = parse_git_tree(headers)
+    if tree is None:
+        # Without the tree nothing is known about deleted files either.
+        logger.warning("Unable to fetch the git tree, update skipped.")
+        return None
+
+    tree = [i for i in tree if i["type"] == "blob"]
+    current = {}
+    for i in tree:
+        current[remove_prefix(i["path"])] = i["sha"]
+    if rejected(current):
+        return None
+
+    pulled = []
     for i in tree:
         fpath = remove_prefix(i["path"])
-        gpath = GIT_RAW + i["path"]
+        if manifest.get(fpath) == i["sha"] and exists(fpath):
+            continue
 
+        gpath = GIT_RAW + i["path"]
         if __debug__:
             logger.debug(f"Pull {fpath} from {gpath} to device.")
 
         # Pulling the individual file to update.
-        pull(fpath, gpath, headers)
+        if not pull(fpath, gpath, headers, i.get("size"), i["sha"]):
+            # Never mix files of two versions, the update is tried again next time.
+            for fpath in pulled:
+                remove(fpath + TEMP)
+            return None
+        pulled.append(fpath)
+        gc.collect()
 
+    return current, pulled
+
+
+def pull_bundle(headers: dict, manifest: dict) -> tuple:
+    """Pulls the bundle with a single request and unpacks the changed files.
+    Returns the blob SHA by path of all files and the paths pulled, None on failure.
+
+    The bundle is a zlib stream of the length of the index (>I), the index as
+    json with path, size and git blob SHA of every file and the contents of
+    the files in the same order. Its own blob SHA is kept in the manifest
+    under its path, so an unchanged bundle is not downloaded."""
+    tree = pull_git_tree(headers, lambda entry: entry["path"] == BUNDLE)
+    if not tree:
+        logger.warning(f"Unable to find {BUNDLE} in the git tree, update skipped.")
+        return None
+    bundle_sha = tree[0]["sha"]
+    if manifest.get(BUNDLE) == bundle_sha:
+        return manifest, []
+    if load_manifest(REJECTED).get(BUNDLE) == bundle_sha:
+        logger.warning("This version was rolled back before, update skipped.")
+        return None
 
-def pull_git_tree(headers: dict) -> dict:
-    """Pulls the git tree of the repo."""
-    r, j = None, None
+    gc.collect()
+    r = urequests.get(GIT_RAW + BUNDLE, stream=True, headers=headers)
+    pulled = []
+    try:
+        if r.status_code != 200:
+            raise OSError(f"HTTP status {r.status_code}")
+        stream = zlib.DecompIO(r.raw, BUNDLE_WBITS)
+        size = struct.unpack(">I", stream.read(4))[0]
+        index = json.loads(stream.read(size))
+
+        current = {BUNDLE: bundle_sha}
+        for fpath, size, sha in index:
+            if GIT_SUBFOLDER + fpath in IGNORE_FILES:
+                receive(stream, None, size)
+                continue
+            current[fpath] = sha
+            if manifest.get(fpath) == sha and exists(fpath):
+                # Checked anyway, a corrupt bundle must not be half installed.
+                receive(stream, None, size, sha)
+                continue
+            pulled.append(fpath)
+            receive(stream, fpath, size, sha)
+        r.close()
+    except Exception as e:
+        logger.error(f"Unable to unpack {BUNDLE}. {e}")
+        r.close()
+        for fpath in pulled:
+            remove(fpath + TEMP)
+        return None
+    return current, pulled
+
+
+def rejected(current: dict) -> bool:
+    """Whether the version was rolled back before."""
+    if current == load_manifest(REJECTED):
+        logger.warning("This version was rolled back before, update skipped.")
+        return True
+    return False
+
+
+def install(fpath: str) -> None:
+    """Renames the pulled file into place, the previous version is kept as backup."""
+    remove(fpath + BACKUP)
+    if exists(fpath):
+        os.rename(fpath, fpath + BACKUP)
+    os.rename(fpath + TEMP, fpath)
+
+
+def boot_check() -> None:
+    """Called early on every boot. Rolls back an update that the previous boot
+    did not confirm, otherwise gives this boot CONFIRM_TIMEOUT seconds to do so."""
+    global _confirm_timer, _checked
+    if _checked:
+        return
+    _checked = True
+    pending = load_pending()
+    if pending is None:
+        return
+
+    if pending["boots"] > 0 or not pending["installed"]:
+        logger.error("Update was not confirmed or not installed completely, rolling back.")
+        rollback(pending)
+        machine.reset()
+
+    pending["boots"] = pending["boots"] + 1
+    save_pending(pending)
+    # Also catches a main.py which stopped with an exception.
+    _confirm_timer = machine.Timer(0)
+    _confirm_timer.init(
+        period=CONFIRM_TIMEOUT * 1000, mode=machine.Timer.ONE_SHOT, callback=lambda t: machine.reset()
+    )
+
+
+def confirm() -> None:
+    """Keep the last update once the device runs fine with it."""
+    if _confirm_timer is not None:
+        _confirm_timer.deinit()
+    pending = load_pending()
+    if pending is None:
+        return
+
+    for fpath in pending["files"]:
+        remove(fpath + BACKUP)
+    remove(PENDING)
+    logger.info("Update confirmed.")
+
+
+def rollback(pending: dict) -> None:
+    """Restore the files as they were before the update."""
+    if pending["installed"]:
+        remove(REJECTED)
+        os.rename(MANIFEST, REJECTED)
+    for fpath, existed in pending["files"].items():
+        remove(fpath + TEMP)
+        if not existed:
+            remove(fpath)
+        elif exists(fpath + BACKUP):
+            remove(fpath)
+            os.rename(fpath + BACKUP, fpath)
+    remove(PENDING)
+
+
+def pull_git_tree(headers: dict, keep) -> list:
+    """Pulls the git tree of the repo, keeping the entries for which keep is true.
+    Returns None if the tree could not be fetched."""
     gc.collect()
 
     if __debug__:
         logger.debug(f"Sending request to fetch git tree : {GIT_TREE_URL}.")
-    
-    rcount = 0
-    while True:
+
+    for _ in range(6):
+        r = None
         try:
             r = urequests.get(GIT_TREE_URL, stream=True, headers=headers)
-            j = json.loads(r.content.decode("utf-8"))
-        except Exception as e: 
-            if isinstance(e, OSError) and r: 
+            if r.status_code != 200:
+                raise OSError(f"HTTP status {r.status_code}")
+            entries = parse_tree_stream(r.raw, keep)
+            r.close()
+            gc.collect()
+            return entries
+        except Exception as e:
+            logger.warning(f"Unable to fetch the git tree. {e}")
+            if r:
                 r.close()
 
-        if rcount > 5:
+    gc.collect()
+    return None
+
+
+def parse_tree_stream(stream, keep) -> list:
+    """Parses the json of the git tree in chunks read from stream.
+
+    Only a single entry of the tree array is held as json at a time, the
+    memory is set by the entries kept. Of those only path, type, sha and size
+    are kept."""
+    entries = []
+    buf = bytearray(CHUNK_SIZE)
+    entry = None
+    depth = 0
+    in_string = escaped = False
+    found = False
+    while True:
+        n = stream.readinto(buf)
+        if not n:
             break
-        rcount = rcount + 1
+        for i in range(n):
+            c = buf[i]
+            if entry is not None:
+                entry.append(c)
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == 0x5C:  # \
+                    escaped = True
+                elif c == 0x22:  # "
+                    in_string = False
+            elif c == 0x22:
+                in_string = True
+            elif c == 0x7B or c == 0x5B:  # { [
+                depth = depth + 1
+                if depth == 2 and c == 0x5B:
+                    # The tree array is the only one of the top level object.
+                    found = True
+                elif depth == 3 and c == 0x7B:
+                    entry = bytearray(b"{")
+            elif c == 0x7D or c == 0x5D:  # } ]
+                depth = depth - 1
+                if depth == 2 and entry is not None:
+                    item = json.loads(entry)
+                    entry = None
+                    if keep(item):
+                        entries.append({k: item[k] for k in ("path", "type", "sha", "size") if k in item})
+
+    if not found or depth:
+        raise ValueError("Incomplete git tree")
+    return entries
 
-    gc.collect()
-    return j
+
+def wanted(entry: dict) -> bool:
+    """Whether an entry of the git tree is subject to OTA updates."""
+    return entry["path"].startswith(GIT_SUBFOLDER) and entry["path"] not in IGNORE_FILES
 
 
 def parse_git_tree(headers: dict) -> list:
-    """Parsing the git tree for desired files."""
-    tree = pull_git_tree(headers)
-    
-    # Construct the file list for updating.
-    files = list()
-
-    if tree is not None:
-        if 'tree' in tree:
-            for i in tree["tree"]:
-                if i["path"].startswith(GIT_SUBFOLDER) and not i["path"] in IGNORE_FILES:
-                    files.append(i)
+    """Parsing the git tree for desired files.
+    Returns None if the tree could not be fetched."""
+    files = pull_git_tree(headers, wanted)
 
     if __debug__:
         logger.debug(f"Files that should be updated : {files}.")
@@ -134,3 +458,52 @@ def remove_prefix(fpath: str) -> str:
     if fpath.startswith(GIT_SUBFOLDER):
         return fpath[len(GIT_SUBFOLDER) :]
     return fpath
+
+
+def exists(fpath: str) -> bool:
+    try:
+        os.stat(fpath)
+        return True
+    except OSError:
+        return False
+
+
+def remove(fpath: str) -> None:
+    try:
+        os.remove(fpath)
+    except OSError:
+        pass
+
+
+def make_dirs(fpath: str) -> None:
+    """Creates the folders of a file pulled into a new subfolder."""
+    path = ""
+    for folder in fpath.split("/")[:-1]:
+        path = path + folder
+        if not exists(path):
+            os.mkdir(path)
+        path = path + "/"
+
+
+def load_manifest(fpath: str = MANIFEST) -> dict:
+    """Returns the blob SHA by path of the files on the device."""
+    try:
+        with open(fpath, "r") as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def load_pending() -> dict:
+    try:
+        with open(PENDING, "r") as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def save_pending(pending: dict) -> None:
+    with open(PENDING + TEMP, "w") as f:
+        json.dump(pending, f)
+    remove(PENDING)
+    os.rename(PENDING + TEMP, PENDING)
@@ -0,0 +1,44 @@
+"""Micro-benchmark of a logging call with its level disabled and enabled.
+
+Usage: python3 tests/bench_logging.py [calls]
+
+Runs esp32/logging.py on CPython. The absolute numbers are far below the
+ones on the device, the ratios between them carry over.
+"""
+import importlib.util
+import io
+import os
+import sys
+import time
+
+import conftest
+
+# Loaded by path, the name logging is taken by the one of CPython.
+_spec = importlib.util.spec_from_file_location("device_logging", os.path.join(conftest.ESP32, "logging.py"))
+logging = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(logging)
+
+
+def per_call(fn, calls):
+    """Nanoseconds per call of fn."""
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def main(calls):
+    logging.basicConfig(level=logging.INFO, stream=io.StringIO(), force=True)
+    logger = logging.getLogger("bench")
+
+    results = (
+        ("disabled, lazy args", per_call(lambda i: logger.debug("value %s", i), calls)),
+        ("disabled, f-string", per_call(lambda i: logger.debug(f"value {i}"), calls)),
+        ("enabled, lazy args", per_call(lambda i: logger.info("value %s", i), calls // 4)),
+    )
+    for name, ns in results:
+        print(f"{name:<20} {ns:7.0f} ns per call")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,84 @@
+"""Runs the modules of esp32/ on CPython.
+
+The MicroPython only modules they import are replaced by minimal stand-ins,
+just enough for the code under test. Hardware is faked by the tests.
+"""
+import asyncio
+import ctypes
+import os
+import sys
+import time
+import types
+
+ESP32 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "esp32")
+sys.path.insert(0, ESP32)
+
+
+def _module(name, **attrs):
+    if name in sys.modules:
+        return
+    try:
+        __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, id, mode=-1, *args, **kwargs):
+        self.id = id
+        self.handler = None
+        self.level = 0
+
+    def irq(self, handler=None, trigger=IRQ_RISING):
+        self.handler = handler
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+        self.level = level
+
+
+def _bytearray_at(addr, size):
+    return (ctypes.c_ubyte * size).from_address(addr)
+
+
+_module("micropython", const=lambda x: x)
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id):
+        self.callback = None
+
+    def init(self, period=-1, mode=PERIODIC, callback=None):
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+
+_module("machine", Pin=Pin, Timer=Timer, I2C=object, reset=lambda: None)
+_module("network", STA_IF=0, WLAN=None)
+_module("urequests", get=None)
+_module("uasyncio", sleep_ms=lambda ms: asyncio.sleep(ms / 1000), run=asyncio.run)
+_module("uctypes", addressof=lambda obj: obj.buffer_info()[0], bytearray_at=_bytearray_at)
+
+# The time module of MicroPython has the ticks functions, utime is the same.
+for _name, _fn in (
+    ("ticks_ms", lambda: int(time.monotonic() * 1000)),
+    ("ticks_us", lambda: int(time.monotonic() * 1000000)),
+    ("ticks_diff", lambda a, b: a - b),
+    ("ticks_add", lambda a, b: a + b),
+    ("sleep_ms", lambda ms: time.sleep(ms / 1000)),
+    ("sleep_us", lambda us: time.sleep(us / 1000000)),
+):
+    if not hasattr(time, _name):
+        setattr(time, _name, _fn)
+sys.modules.setdefault("utime", time)
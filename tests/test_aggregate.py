@@ -0,0 +1,50 @@
+import json
+
+from aggregate import Aggregator
+from spool import Spool
+
+
+def scd30_summary():
+    aggregator = Aggregator(61)
+    for i in range(61):
+        aggregator.add({"temperature": 21.3 + i * 0.013, "co2": 412.7 + i * 1.37, "humidity": 45.1 - i * 0.07})
+    return aggregator.summary()
+
+
+def test_summary_is_rounded():
+    summary = scd30_summary()
+    assert len(summary) == 15
+    assert all(value == round(value, 2) for value in summary.values())
+    assert summary["co2_min"] == 412.7
+
+
+def test_summary_survives_the_spool(tmp_path):
+    # As serialise in main.py queues it, with the fields of the header.
+    reading = {
+        "datetime": "2026-10-18 12:00:00",
+        "timestamp": 1792324800000,
+        "device_id": 123456789012345,
+        "location": "greenhouse",
+    }
+    reading.update(scd30_summary())
+    payload = json.dumps(reading)
+
+    spool = Spool(str(tmp_path / "spool.dat"), records=16, record_size=384)
+    spool.push(payload)
+    assert json.loads(spool.peek()) == reading
+
+
+def test_resize_keeps_the_newest_samples():
+    aggregator = Aggregator(4)
+    for value in (1.0, 2.0, 3.0, 4.0, 5.0, 6.0):
+        aggregator.add({"co2": value})
+    # The window holds 3, 4, 5, 6 with the ring buffer wrapped.
+    aggregator.resize(3)
+    summary = aggregator.summary()
+    assert (summary["co2_min"], summary["co2_max"], summary["co2"]) == (4.0, 6.0, 6.0)
+
+    aggregator.resize(8)
+    for value in (7.0, 8.0, 9.0, 10.0, 11.0):
+        aggregator.add({"co2": value})
+    summary = aggregator.summary()
+    assert (summary["co2_min"], summary["co2_max"], summary["co2_mean"]) == (4.0, 11.0, 7.5)
@@ -0,0 +1,77 @@
+import importlib
+import json
+import shutil
+import sys
+
+import pytest
+
+import conftest
+
+# The config of the first release, before any of the keys in DEFAULTS.
+FIRST_RELEASE = {
+    "Network": {"SSID": "", "PASS": ""},
+    "SCD30_offsets": {"tempOffset": -2.0, "co2Offset": 0.0, "humidityOffset": 10.0},
+    "AWS_IOT_core": {
+        "THING_NAME": "esp32",
+        "TOPIC": "ESP32/Sensors",
+        "ENDPOINT": "example.iot.eu-central-1.amazonaws.com",
+        "ROOT_CA": "cert/AmazonRootCA1.pem",
+        "CERTIFICATE": "cert/certificate.pem.crt",
+        "PRIVATE_KEY": "cert/private.pem.key",
+    },
+    "Github": {"user": "heytupu", "repo": "esp32", "secret_access_token": ""},
+    "Sensors": {
+        "SCD30": {"Pin": [22, 21], "Boolean": 0, "CO2_Value": 0},
+        "Moisture_Sensor": {"Pin": [31, 32, 34, 35], "Boolean": 0},
+        "DS18B20": {"Pin": [25, 26, 27, 14], "Boolean": 0, "Name": ["pipe_sensor_1"]},
+        "AM2302": {"Pin": 25, "Boolean": 0},
+    },
+    "Device_settings": {"Time_Interval": 60, "location": "", "UTC_Offset": 1},
+}
+
+
+def load(tmp_path, monkeypatch, cfg):
+    """Import config.py afresh in a directory with cfg as its config file."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "configs").mkdir(exist_ok=True)
+    (tmp_path / "configs" / "config.json").write_text(json.dumps(cfg))
+    for name in ("config", "config_cache"):
+        sys.modules.pop(name, None)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return importlib.import_module("config")
+
+
+def test_shipped_config_is_valid(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shutil.copytree(conftest.ESP32 + "/configs", tmp_path / "configs")
+    sys.modules.pop("config", None)
+    config = importlib.import_module("config")
+    assert config.CFG["Session"]["QoS"] == 1
+
+
+def test_missing_keys_are_taken_from_the_defaults(tmp_path, monkeypatch):
+    config = load(tmp_path, monkeypatch, FIRST_RELEASE)
+    assert config.CFG["Github"]["Confirm_Timeout"] == 600
+    assert config.CFG["Sensors"]["SCD30"]["Pin"] == [22, 21]
+    assert config.CFG["Sensors"]["SCD30"]["RDY_Pin"] is None
+    assert config.CFG["Device_settings"]["Encoding"] == "json"
+    assert config.CFG["Logging"]["Remote"]["Boolean"] == 0
+
+    # The next boot takes the cache.
+    assert (tmp_path / "config_cache.py").exists()
+    config = load(tmp_path, monkeypatch, FIRST_RELEASE)
+    assert "config_cache" in sys.modules
+
+
+def test_wrong_types_are_still_rejected(tmp_path, monkeypatch):
+    cfg = json.loads(json.dumps(FIRST_RELEASE))
+    cfg["Device_settings"]["Time_Interval"] = "60"
+    with pytest.raises(ValueError, match="Time_Interval"):
+        load(tmp_path, monkeypatch, cfg)
+
+
+def test_keys_without_default_are_required(tmp_path, monkeypatch):
+    cfg = json.loads(json.dumps(FIRST_RELEASE))
+    del cfg["Network"]
+    with pytest.raises(ValueError, match="Network"):
+        load(tmp_path, monkeypatch, cfg)
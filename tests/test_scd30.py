@@ -0,0 +1,108 @@
+import struct
+import tracemalloc
+from array import array
+
+from machine import Pin
+from scd30 import SCD30
+
+ADDR = 0x61
+
+
+def crc(msb, lsb):
+    return SCD30.CRC_TABLE[SCD30.CRC_TABLE[0xFF ^ msb] ^ lsb]
+
+
+def words(*values):
+    """Sensor response for the big endian floats, a CRC after every word."""
+    out = bytearray()
+    for value in values:
+        raw = struct.pack(">f", value)
+        for i in (0, 2):
+            out += bytes((raw[i], raw[i + 1], crc(raw[i], raw[i + 1])))
+    return bytes(out)
+
+
+class FakeI2C:
+    """Answers reads with the response to the last command written."""
+
+    def __init__(self, measurement=(412.5, 21.25, 45.5)):
+        self.responses = {
+            SCD30.READ_MEASUREMENT: words(*measurement),
+            SCD30.GET_STATUS_READY: bytes((0, 1, crc(0, 1))),
+        }
+        self.cmd = None
+        self.transfers = 0
+
+    def scan(self):
+        return [ADDR]
+
+    def writeto(self, addr, buf):
+        self.cmd = buf[0] << 8 | buf[1]
+        self.transfers += 1
+
+    def readfrom_into(self, addr, buf):
+        buf[:] = self.responses[self.cmd][: len(buf)]
+        self.transfers += 1
+
+
+def test_read_measurement_into():
+    sensor = SCD30(FakeI2C(), ADDR, pause=0)
+    values = array("f", (0.0, 0.0, 0.0))
+    sensor.read_measurement_into(values)
+    assert list(values) == [412.5, 21.25, 45.5]
+    assert sensor.read_measurement() == (412.5, 21.25, 45.5)
+
+
+def test_read_measurement_into_does_not_allocate():
+    sensor = SCD30(FakeI2C(), ADDR, pause=0)
+    values = array("f", (0.0, 0.0, 0.0))
+    # Warm up, the first call creates the byte view on values.
+    sensor.read_measurement_into(values)
+
+    # Only the memory allocated by scd30.py counts, not the one of the test.
+    only_scd30 = [tracemalloc.Filter(True, SCD30.__init__.__code__.co_filename)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(only_scd30)
+        for _ in range(100):
+            sensor.read_measurement_into(values)
+        after = tracemalloc.take_snapshot().filter_traces(only_scd30)
+    finally:
+        tracemalloc.stop()
+
+    grown = [stat for stat in after.compare_to(before, "lineno") if stat.count_diff > 0]
+    assert grown == []
+
+
+def test_rdy_pin_flags_measurements_without_i2c():
+    i2c = FakeI2C()
+    rdy = Pin(4, Pin.IN)
+    sensor = SCD30(i2c, ADDR, pause=0, rdy_pin=rdy)
+    assert rdy.handler is not None
+
+    assert not sensor.data_ready()
+    assert not sensor.wait_ready(timeout_ms=30)
+    assert i2c.transfers == 0
+
+    # Rising edge of RDY.
+    rdy.handler(rdy)
+    assert sensor.data_ready()
+    assert sensor.wait_ready(timeout_ms=30)
+    assert i2c.transfers == 0
+
+    sensor.read_measurement_into(array("f", (0.0, 0.0, 0.0)))
+    assert not sensor.data_ready()
+
+
+def test_rdy_pin_already_high():
+    # The edge of a measurement waiting since before the irq was set is missed.
+    rdy = Pin(4, Pin.IN)
+    rdy.value(1)
+    assert SCD30(FakeI2C(), ADDR, pause=0, rdy_pin=rdy).data_ready()
+
+
+def test_without_rdy_pin_polls_the_status():
+    i2c = FakeI2C()
+    sensor = SCD30(i2c, ADDR, pause=0)
+    assert sensor.data_ready()
+    assert i2c.transfers == 2
@@ -0,0 +1,99 @@
+import pytest
+
+from spool import Spool
+
+
+def drain(spool):
+    out = []
+    while len(spool):
+        out.append(spool.peek())
+        spool.pop()
+    return out
+
+
+def test_payloads_larger_than_a_slot_span_several(tmp_path):
+    spool = Spool(str(tmp_path / "spool.dat"), records=8, record_size=32)
+    payloads = [b"a" * 10, b"b" * 60, b"c" * 26, b"d" * 27]
+    for payload in payloads:
+        spool.push(payload)
+    assert spool.used == 1 + 3 + 1 + 2
+    assert drain(spool) == payloads
+    assert spool.used == 0
+
+
+def test_spanning_payloads_wrap_around(tmp_path):
+    spool = Spool(str(tmp_path / "spool.dat"), records=4, record_size=16)
+    for i in range(10):
+        payload = bytes([65 + i]) * 25
+        spool.push(payload)
+        assert spool.peek() == payload
+        spool.pop()
+
+
+def test_full_queue_drops_the_oldest_payloads(tmp_path):
+    spool = Spool(str(tmp_path / "spool.dat"), records=4, record_size=16)
+    spool.push(b"a" * 5)
+    spool.push(b"b" * 5)
+    spool.push(b"c" * 15)
+    # Needs 3 of the 4 slots, a, b and c go.
+    spool.push(b"d" * 25)
+    assert drain(spool) == [b"d" * 25]
+
+
+def test_too_large_for_the_whole_spool(tmp_path):
+    spool = Spool(str(tmp_path / "spool.dat"), records=4, record_size=16)
+    with pytest.raises(Spool.RecordTooLarge):
+        spool.push(b"x" * 41)
+
+
+def test_recovered_after_reboot(tmp_path):
+    path = str(tmp_path / "spool.dat")
+    spool = Spool(path, records=8, record_size=16)
+    for payload in (b"a" * 5, b"b" * 20, b"c" * 30, b"d" * 5):
+        spool.push(payload)
+    spool.pop()
+    spool.pop()
+    spool.close()
+
+    spool = Spool(path, records=8, record_size=16)
+    assert (len(spool), spool.used) == (2, 4)
+    spool.push(b"e" * 15)
+    assert drain(spool) == [b"c" * 30, b"d" * 5, b"e" * 15]
+
+
+def test_interrupted_write_is_ignored(tmp_path):
+    path = str(tmp_path / "spool.dat")
+    spool = Spool(path, records=6, record_size=16)
+    spool.push(b"a" * 5)
+    spool.close()
+    # Only the continued slot of the next payload made it to flash.
+    with open(path, "r+b") as f:
+        f.seek(2 * 16)
+        f.write(b"\x00\x00\x00\x05\xff\xff")
+
+    spool = Spool(path, records=6, record_size=16)
+    assert (len(spool), spool.used) == (1, 1)
+    spool.push(b"b" * 20)
+    assert drain(spool) == [b"a" * 5, b"b" * 20]
+
+
+def test_push_front_keeps_the_order(tmp_path):
+    path = str(tmp_path / "spool.dat")
+    spool = Spool(path, records=8, record_size=16)
+    spool.push(b"c" * 5)
+    spool.push(b"d" * 5)
+    # Sent before c and d, but never acknowledged.
+    for payload in reversed([b"a" * 5, b"b" * 30]):
+        spool.push_front(payload)
+    spool.close()
+
+    spool = Spool(path, records=8, record_size=16)
+    assert drain(spool) == [b"a" * 5, b"b" * 30, b"c" * 5, b"d" * 5]
+
+
+def test_push_front_drops_the_payload_if_full(tmp_path):
+    spool = Spool(str(tmp_path / "spool.dat"), records=2, record_size=16)
+    spool.push(b"c" * 5)
+    spool.push(b"d" * 5)
+    spool.push_front(b"a" * 5)
+    assert drain(spool) == [b"c" * 5, b"d" * 5]
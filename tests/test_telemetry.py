@@ -0,0 +1,19 @@
+import telemetry
+
+
+def test_round_trip():
+    samples = [{"temperature": 21.25, "co2": 412.5, "offset": 0}, {"humidity": 45.5, "offset": 1500}]
+    message = telemetry.decode(telemetry.encode(7, "roof", 1000, samples))
+    assert message["device_id"] == 7
+    assert message["location"] == "roof"
+    assert message["samples"] == [
+        {"offset": 0, "temperature": 21.25, "co2": 412.5},
+        {"offset": 1.5, "humidity": 45.5},
+    ]
+
+
+def test_unmapped_fields_are_left_out():
+    sample = {"temperature": 21.25, "temperature_max": 22.0, "pipe_sensor_1_2": 9.5, "moisture_5": 30.0}
+    assert telemetry.unmapped(sample) == ["pipe_sensor_1_2", "moisture_5"]
+    message = telemetry.decode(telemetry.encode(7, "roof", 1000, [sample]))
+    assert message["samples"] == [{"offset": 0, "temperature": 21.25, "temperature_max": 22.0}]
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import ugit
+
+
+class Reset(Exception):
+    pass
+
+
+def reset():
+    raise Reset
+
+
+def install(tmp_path, monkeypatch):
+    """An installed update of main.py, the previous version kept as backup.
+    A reset of the board raises Reset."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ugit, "_checked", False)
+    monkeypatch.setattr(ugit.machine, "reset", reset)
+    (tmp_path / "main.py").write_text("new")
+    (tmp_path / "main.py.bak").write_text("old")
+    (tmp_path / "ugit.json").write_text(json.dumps({"main.py": "sha"}))
+    ugit.save_pending({"boots": 0, "installed": True, "files": {"main.py": True}})
+
+
+def test_boot_check_counts_a_boot_once(tmp_path, monkeypatch):
+    install(tmp_path, monkeypatch)
+    # boot.py runs as a script, then again when main.py imports it.
+    ugit.boot_check()
+    ugit.boot_check()
+    assert ugit.load_pending()["boots"] == 1
+    assert (tmp_path / "main.py").read_text() == "new"
+
+
+def test_unconfirmed_update_is_rolled_back_next_boot(tmp_path, monkeypatch):
+    install(tmp_path, monkeypatch)
+    ugit.boot_check()
+    # Reset without a confirm, a new boot loads ugit again.
+    monkeypatch.setattr(ugit, "_checked", False)
+    with pytest.raises(Reset):
+        ugit.boot_check()
+    assert (tmp_path / "main.py").read_text() == "old"
+    assert ugit.load_pending() is None
+    assert json.loads((tmp_path / "ugit.rejected").read_text()) == {"main.py": "sha"}
+
+
+def test_confirm_keeps_the_update(tmp_path, monkeypatch):
+    install(tmp_path, monkeypatch)
+    ugit.boot_check()
+    ugit.confirm()
+    monkeypatch.setattr(ugit, "_checked", False)
+    ugit.boot_check()
+    assert (tmp_path / "main.py").read_text() == "new"
+    assert not (tmp_path / "main.py.bak").exists()